@@ -0,0 +1,244 @@
+"""
+Fake remote host for benchmarks: remote commands run locally, rooted in a temp folder
+
+Fabric's run()/sudo(), SSH channels (deploytool.utils.commands.open_channel)
+and put()/get() are replaced by local equivalents that count round trips and
+bytes in both directions. System commands that can't run unprivileged
+(virtualenv, pip, mysql, useradd, init scripts, ...) are replaced by the
+stand-ins in ./shims via PATH.
+"""
+
+from fabric.api import *
+from fabric.operations import _AttributeString, _handle_failure, _prefix_commands, _prefix_env_vars, _shell_wrap
+import fabric.network
+import fabric.operations
+import glob
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+
+
+SHIMS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'shims')
+
+
+class FakeHost(object):
+    """ Local stand-in for an SSH host, see install() """
+
+    def __init__(self, root):
+
+        self.root = root
+        self.bin_path = os.path.join(root, 'bin')
+        self.lock = threading.Lock()
+        self.round_trips = 0
+        self.bytes_up = 0
+        self.bytes_down = 0
+
+    def settings(self):
+        """ Returns fabric env settings that point deploytool to paths inside the fake host """
+
+        return {
+            'projects_root': os.path.join(self.root, 'projects'),
+            'home_root': os.path.join(self.root, 'home'),
+            'apache_conf_path': os.path.join(self.root, 'etc', 'httpd', 'conf.d'),
+            'nginx_conf_path': os.path.join(self.root, 'etc', 'nginx', 'conf.d'),
+            'init_path': os.path.join(self.root, 'etc', 'init.d'),
+            'local_ssh_path': os.path.join(self.root, 'local_ssh'),
+            'shell': '/bin/bash -c',
+        }
+
+    def install(self):
+        """ Creates folders and shims, patches fabric and deploytool to use this host """
+
+        for folder in self.settings().values() + [self.bin_path]:
+            if folder.startswith(self.root) and not os.path.exists(folder):
+                os.makedirs(folder)
+
+        # shims
+        for name in os.listdir(SHIMS_PATH):
+            if name != 'noop' and not name.endswith('.py') and not name.endswith('.pyc'):
+                os.symlink(os.path.join(SHIMS_PATH, name), os.path.join(self.bin_path, name))
+        for name in ['passwd', 'chown', 'htpasswd', 'visudo']:
+            os.symlink(os.path.join(SHIMS_PATH, 'noop'), os.path.join(self.bin_path, name))
+        for name in ['httpd', 'nginx']:
+            os.symlink(os.path.join(SHIMS_PATH, 'noop'), os.path.join(self.settings()['init_path'], name))
+        os.symlink(sys.executable, os.path.join(self.bin_path, 'python'))
+
+        # an existing vhost, setup takes the next port
+        open(os.path.join(self.settings()['apache_conf_path'], 'vhosts-other.conf'), 'w').write('NameVirtualHost *:8000\n')
+
+        os.environ.update({
+            'PATH': '%s:%s:%s' % (self.bin_path, SHIMS_PATH, os.environ['PATH']),
+            'PYTHONPATH': SHIMS_PATH,
+            'BENCHMARK_DB': os.path.join(self.root, 'database.sqlite3'),
+            'BENCHMARK_HOME_ROOT': self.settings()['home_root'],
+            'BENCHMARK_PYTHON': sys.executable,
+        })
+
+        fabric.operations._run_command = self.run_command
+        self.patch('connect', self.connect)
+        self.patch('put', self.put)
+        self.patch('get', self.get)
+
+    def patch(self, name, replacement):
+        """ Replaces fabric function name in every module that imported it """
+
+        original = getattr(name == 'connect' and fabric.network or fabric.operations, name)
+        for module in sys.modules.values():
+            if module and (module.__name__.startswith('deploytool') or module.__name__.startswith('fabric')):
+                if getattr(module, name, None) is original:
+                    setattr(module, name, replacement)
+
+    def count(self, up=0, down=0, round_trips=0):
+
+        with self.lock:
+            self.round_trips += round_trips
+            self.bytes_up += up
+            self.bytes_down += down
+
+    def connect(self, user, host, port):
+        """ Replaces fabric.network.connect() """
+
+        return FakeClient(self)
+
+    def run_command(self, command, shell=True, pty=True, combine_stderr=None, sudo=False, user=None):
+        """ Replaces fabric.operations._run_command(), sudo runs as current user """
+
+        wrapped_command = _shell_wrap(_prefix_commands(_prefix_env_vars(command), 'remote'), shell, None)
+        if combine_stderr is None:
+            combine_stderr = env.combine_stderr
+
+        process = subprocess.Popen(
+            wrapped_command,
+            shell=True,
+            stdout=subprocess.PIPE,
+            stderr=combine_stderr and subprocess.STDOUT or subprocess.PIPE
+        )
+        stdout, stderr = process.communicate()
+        self.count(up=len(wrapped_command), down=len(stdout) + len(stderr or ''), round_trips=1)
+
+        # a pty turns newlines into CRLF
+        stdout = stdout.strip()
+        if pty:
+            stdout = stdout.replace('\n', '\r\n')
+
+        out = _AttributeString(stdout)
+        out.failed = process.returncode != 0
+        if out.failed:
+            _handle_failure(message="%s() encountered an error (return code %s) while executing '%s'" % (
+                sudo and 'sudo' or 'run',
+                process.returncode,
+                command
+            ))
+        out.return_code = process.returncode
+        out.succeeded = not out.failed
+        out.stderr = _AttributeString((stderr or '').strip())
+
+        return out
+
+    def put(self, local_path=None, remote_path=None, use_sudo=False, mirror_local_mode=False, mode=None):
+        """ Replaces fabric.operations.put() """
+
+        if hasattr(local_path, 'read'):
+            sources = [(None, local_path.read())]
+        else:
+            sources = [(path, open(path, 'rb').read()) for path in glob.glob(os.path.expanduser(local_path))]
+
+        remote_paths = []
+        for path, data in sources:
+            target = remote_path
+            if path and os.path.isdir(target):
+                target = os.path.join(target, os.path.basename(path))
+            open(target, 'wb').write(data)
+            if mode:
+                os.chmod(target, mode)
+
+            self.count(up=len(data), round_trips=1)
+            remote_paths.append(target)
+
+        return remote_paths
+
+    def get(self, remote_path, local_path=None):
+        """ Replaces fabric.operations.get() """
+
+        local_path = local_path or os.path.basename(remote_path)
+        shutil.copy(remote_path, local_path)
+        self.count(down=os.path.getsize(local_path), round_trips=1)
+
+        return [local_path]
+
+
+class FakeClient(object):
+    """ Stands in for both paramiko's SSHClient and its Transport """
+
+    def __init__(self, host):
+
+        self.host = host
+
+    def get_transport(self):
+
+        return self
+
+    def open_session(self):
+
+        return FakeChannel(self.host)
+
+    def set_keepalive(self, interval):
+
+        pass
+
+    def close(self):
+
+        pass
+
+
+class FakeChannel(object):
+    """ Stands in for a paramiko Channel running a single command """
+
+    def __init__(self, host):
+
+        self.host = host
+        self.process = None
+        self.stderr = tempfile.TemporaryFile()
+
+    def exec_command(self, command):
+
+        self.process = subprocess.Popen(
+            command,
+            shell=True,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=self.stderr
+        )
+        self.host.count(up=len(command), round_trips=1)
+
+    def sendall(self, data):
+
+        self.process.stdin.write(data)
+        self.host.count(up=len(data))
+
+    def shutdown_write(self):
+
+        self.process.stdin.close()
+
+    def recv(self, size):
+
+        data = os.read(self.process.stdout.fileno(), size)
+        self.host.count(down=len(data))
+
+        return data
+
+    def recv_exit_status(self):
+
+        return self.process.wait()
+
+    def makefile_stderr(self, mode='rb'):
+
+        self.stderr.seek(0)
+        return self.stderr
+
+    def close(self):
+
+        self.process.stdout.close()
@@ -0,0 +1,118 @@
+"""
+Synthetic Django project in a local git repository, sized by the benchmark options
+"""
+
+import os
+import random
+import subprocess
+
+
+MANAGE_PY = '''#!/usr/bin/env python
+""" Stand-in for Django's manage.py: collectstatic links static files, everything else succeeds """
+
+import os
+import sys
+
+source_path = os.path.dirname(os.path.abspath(__file__))
+
+if sys.argv[1] == 'collectstatic':
+    for root, dirs, files in os.walk(os.path.join(source_path, 'static')):
+        target_root = root.replace(os.path.join(source_path, 'static'), os.path.join(source_path, 'static_root'), 1)
+        if not os.path.exists(target_root):
+            os.makedirs(target_root)
+        for name in files:
+            os.link(os.path.join(root, name), os.path.join(target_root, name))
+'''
+
+WORDS = ['def', 'return', 'self', 'import', 'class', 'object', 'value', 'request', 'response', 'model', 'field', 'None']
+
+
+def git(path, *args):
+
+    environment = dict(os.environ, GIT_AUTHOR_NAME='benchmark', GIT_AUTHOR_EMAIL='benchmark@localhost',
+        GIT_COMMITTER_NAME='benchmark', GIT_COMMITTER_EMAIL='benchmark@localhost')
+    process = subprocess.Popen(['git'] + list(args), cwd=path, env=environment, stdout=subprocess.PIPE)
+
+    return process.communicate()[0].strip()
+
+
+def write_source_file(path, size):
+    """ Writes about size bytes of source-like text (compresses like real source) """
+
+    lines = []
+    length = 0
+    while length < size:
+        line = '    %s\n' % str.join(' ', [random.choice(WORDS) for i in range(8)])
+        lines.append(line)
+        length += len(line)
+
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    open(path, 'w').write(str.join('', lines))
+
+
+def write_requirements(path, count, bumped=0):
+    """ Writes requirements.txt with count packages, the first bumped packages get a new version """
+
+    lines = ['package%04d==%s' % (i, i < bumped and '1.1' or '1.0') for i in range(count)]
+    open(os.path.join(path, 'requirements.txt'), 'w').write(str.join('\n', lines) + '\n')
+
+
+def create_project(path, files=200, file_size=4096, static_files=50, requirements=20, changed_files=10):
+    """
+    Creates project repository with two commits, returns their IDs
+        - first commit: source, static files, requirements, .pth file and manage.py
+        - second commit: changes changed_files source files and bumps one requirement
+    """
+
+    random.seed(0)
+    os.makedirs(path)
+    git(path, 'init', '-q')
+
+    open(os.path.join(path, 'manage.py'), 'w').write(MANAGE_PY)
+    open(os.path.join(path, 'project.pth'), 'w').write('%s\n' % path)
+    write_requirements(path, requirements)
+
+    for index in range(files):
+        write_source_file(os.path.join(path, 'app%d' % (index % 10), 'module_%04d.py' % index), file_size)
+    for index in range(static_files):
+        write_source_file(os.path.join(path, 'static', 'css', 'style_%04d.css' % index), file_size)
+
+    git(path, 'add', '-A')
+    git(path, 'commit', '-q', '-m', 'Initial commit')
+    first_commit = git(path, 'rev-parse', 'HEAD')
+
+    for index in random.sample(range(files), min(changed_files, files)):
+        write_source_file(os.path.join(path, 'app%d' % (index % 10), 'module_%04d.py' % index), file_size)
+    write_requirements(path, requirements, bumped=1)
+
+    git(path, 'commit', '-q', '-a', '-m', 'Update')
+    second_commit = git(path, 'rev-parse', 'HEAD')
+
+    return first_commit, second_commit
+
+
+def create_media(path, files=100, file_size=64 * 1024):
+    """ Fills media folder with incompressible files """
+
+    for index in range(files):
+        folder = os.path.join(path, 'uploads', '%02d' % (index % 20))
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        open(os.path.join(folder, 'file_%04d.bin' % index), 'wb').write(os.urandom(file_size))
+
+
+def create_database(database_file, tables=10, rows=1000):
+    """ Fills SQLite stand-in database with tables of rows """
+
+    import sqlite3
+
+    connection = sqlite3.connect(database_file)
+    for table in range(tables):
+        connection.execute('CREATE TABLE table_%02d (id INTEGER PRIMARY KEY, name TEXT, value INTEGER)' % table)
+        connection.executemany(
+            'INSERT INTO table_%02d (name, value) VALUES (?, ?)' % table,
+            [('row %d of table %d' % (r, table), r) for r in range(rows)]
+        )
+    connection.commit()
+    connection.close()
@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+"""
+Benchmarks deploytool tasks against a fake host in a temp folder
+
+    usage: python benchmarks/run.py [options]
+
+Runs setup, keys, deploy (initial and update), status, database, media
+(tarball and sync) and rollback in this order, each in its own process, and
+reports wall time, SSH round trips, bytes up/down and peak memory (RSS) per
+task. Results are compared with a saved baseline (see --save), any metric
+that grew by more than --threshold is reported as a regression and makes
+the run exit with status 1.
+"""
+
+from optparse import OptionParser
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fabric.api import env
+from fabric.network import interpret_host_string
+import deploytool.tasks as tasks
+import deploytool.utils as utils
+
+from fakehost import FakeHost
+import project
+
+
+METRICS = ['seconds', 'round_trips', 'bytes_up', 'bytes_down', 'peak_rss_kb']
+
+# differences below these are noise, whatever the threshold
+NOISE = {'seconds': 0.1, 'round_trips': 0, 'bytes_up': 1024, 'bytes_down': 1024, 'peak_rss_kb': 1024}
+
+HOST = 'fakehost'
+
+# every run installs its own fake host in front of this
+PATH = os.environ['PATH']
+
+
+def get_benchmarks(first_commit, second_commit):
+    """ Returns list of (benchmark name, task, kwargs, run in downloads folder) in order of execution """
+
+    return [
+        ('setup', tasks.provision.Setup(), {}, False),
+        ('keys', tasks.provision.Keys(), {}, False),
+        ('deploy', tasks.remote.Deployment(), {'commit': first_commit}, False),
+        ('deploy_update', tasks.remote.Deployment(), {'commit': second_commit}, False),
+        ('status', tasks.remote.Status(), {}, False),
+        ('sizes', tasks.remote.Sizes(), {'rebuild': '1'}, False),
+        ('database', tasks.remote.Database(), {}, True),
+        ('media', tasks.remote.Media(), {}, True),
+        ('media_sync', tasks.remote.Media(), {'sync': '1'}, True),
+        ('rollback', tasks.remote.Rollback(), {}, False),
+    ]
+
+
+def answer_prompts():
+    """ Answers all questions asked by tasks """
+
+    def prompt(text, key=None, default='', validate=None):
+        value = default or 'benchmark-password'
+        return validate and validate(value) or value
+
+    for module in [tasks.provision, tasks.remote]:
+        module.confirm = lambda *args, **kwargs: True
+        module.prompt = prompt
+
+
+def run_benchmark(host, settings, task, kwargs, cwd, verbose):
+    """ Runs task in a child process, returns dict of metrics (or error) """
+
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+
+    if pid:
+        os.close(write_fd)
+        output = os.fdopen(read_fd).read()
+        os.waitpid(pid, 0)
+        return json.loads(output or '{"error": "benchmark process died"}')
+
+    os.close(read_fd)
+    result = {}
+    try:
+        os.chdir(cwd)
+        if not verbose:
+            devnull = os.open(os.devnull, os.O_WRONLY)
+            os.dup2(devnull, 1)
+            os.dup2(devnull, 2)
+
+        tasks.remote.RemoteHost(settings=settings).run()
+        interpret_host_string(env.hosts[0])
+        env.all_hosts = env.hosts
+        host.count(-host.bytes_up, -host.bytes_down, -host.round_trips)
+
+        start = time.time()
+        try:
+            task.run(**kwargs)
+        except SystemExit:
+            result['error'] = 'aborted'
+
+        result.update({
+            'seconds': round(time.time() - start, 3),
+            'round_trips': host.round_trips,
+            'bytes_up': host.bytes_up,
+            'bytes_down': host.bytes_down,
+            'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        })
+    except BaseException, e:
+        result['error'] = repr(e)
+
+    os.write(write_fd, json.dumps(result))
+    os._exit(0)
+
+
+def run_all(options):
+    """ Creates fake host and project, runs all benchmarks once, returns dict of name => metrics """
+
+    root = tempfile.mkdtemp(prefix='deploytool-benchmark-')
+    results = {}
+
+    try:
+        os.environ['PATH'] = PATH
+        host = FakeHost(os.path.join(root, 'host'))
+        host.install()
+
+        first_commit, second_commit = project.create_project(
+            os.path.join(root, 'project'),
+            files=options.files,
+            file_size=options.file_size,
+            static_files=options.static_files,
+            requirements=options.requirements
+        )
+        downloads_path = os.path.join(root, 'downloads')
+        os.makedirs(downloads_path)
+
+        # a local public key for the keys task
+        open(os.path.join(host.settings()['local_ssh_path'], 'id_rsa.pub'), 'w').write('ssh-rsa AAAAbenchmark benchmark@localhost\n')
+        os.environ['BENCHMARK_PACKAGE_FILES'] = str(options.package_files)
+
+        settings = dict(host.settings(), **{
+            'admin_email': 'benchmark@localhost',
+            'website_name': 'benchmark.localhost',
+            'environment': 'benchmark',
+            'hosts': [HOST],
+            'project_name': 'benchmark',
+            'project_name_prefix': 'b-',
+            'provisioning_user': 'benchmark',
+            'real_fabfile': os.path.abspath(__file__),
+        })
+
+        for name, task, kwargs, in_downloads in get_benchmarks(first_commit, second_commit):
+            if options.only and not name in options.only.split(','):
+                continue
+
+            cwd = in_downloads and downloads_path or os.path.join(root, 'project')
+            results[name] = run_benchmark(host, settings, task, kwargs, cwd, options.verbose)
+
+            if name == 'setup':
+                project_path = os.path.join(settings['projects_root'], 'b-benchmark')
+                project.create_database(os.environ['BENCHMARK_DB'], options.tables, options.rows)
+                project.create_media(os.path.join(project_path, 'media'), options.media_files, options.media_size)
+    finally:
+        if options.keep:
+            print('Kept fake host and project in %s' % root)
+        else:
+            shutil.rmtree(root, True)
+
+    return results
+
+
+def median(values):
+
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def compare(results, baseline, threshold):
+    """ Returns list of (benchmark, metric, baseline value, value) for metrics that grew beyond threshold """
+
+    regressions = []
+    for name in sorted(results.keys()):
+        if not name in baseline or 'error' in results[name]:
+            continue
+        for metric in METRICS:
+            base_value = baseline[name].get(metric)
+            value = results[name][metric]
+            if base_value is not None and value - base_value > max(base_value * threshold, NOISE[metric]):
+                regressions.append((name, metric, base_value, value))
+
+    return regressions
+
+
+def report(results, baseline, order):
+
+    format_size = utils.commands.format_size
+
+    print('%-15s %10s %8s %12s %12s %12s' % ('benchmark', 'seconds', 'trips', 'up', 'down', 'peak RSS'))
+    for name in [n for n in order if n in results]:
+        result = results[name]
+        if 'error' in result and not 'seconds' in result:
+            print('%-15s %s' % (name, result['error']))
+            continue
+
+        print('%-15s %10.2f %8d %12s %12s %12s%s' % (
+            name,
+            result['seconds'],
+            result['round_trips'],
+            format_size(result['bytes_up']),
+            format_size(result['bytes_down']),
+            format_size(result['peak_rss_kb'] * 1024),
+            'error' in result and '  (%s)' % result['error'] or ''
+        ))
+        if name in baseline:
+            base = baseline[name]
+            print('%-15s %+10.2f %+8d %12s %12s %12s' % (
+                '  vs baseline',
+                result['seconds'] - base['seconds'],
+                result['round_trips'] - base['round_trips'],
+                format_size(result['bytes_up'] - base['bytes_up']),
+                format_size(result['bytes_down'] - base['bytes_down']),
+                format_size((result['peak_rss_kb'] - base['peak_rss_kb']) * 1024),
+            ))
+
+
+def main():
+
+    parser = OptionParser(usage='%prog [options]', description=__doc__.strip().split('\n')[0])
+    parser.add_option('--files', type='int', default=200, help='source files in project (%default)')
+    parser.add_option('--file-size', type='int', default=4096, help='bytes per source file (%default)')
+    parser.add_option('--static-files', type='int', default=50, help='static files in project (%default)')
+    parser.add_option('--requirements', type='int', default=20, help='packages in requirements.txt (%default)')
+    parser.add_option('--package-files', type='int', default=20, help='files per installed package (%default)')
+    parser.add_option('--tables', type='int', default=10, help='database tables (%default)')
+    parser.add_option('--rows', type='int', default=1000, help='rows per table (%default)')
+    parser.add_option('--media-files', type='int', default=100, help='media files (%default)')
+    parser.add_option('--media-size', type='int', default=64 * 1024, help='bytes per media file (%default)')
+    parser.add_option('--repeat', type='int', default=1, help='runs to take the median of (%default)')
+    parser.add_option('--only', help='comma separated benchmarks to run (tasks depend on earlier ones)')
+    parser.add_option('--baseline', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json'),
+        help='baseline file (%default)')
+    parser.add_option('--save', action='store_true', help='save results as new baseline')
+    parser.add_option('--threshold', type='float', default=0.2, help='allowed growth per metric, 0.2 is 20%% (%default)')
+    parser.add_option('--keep', action='store_true', help='keep fake host and project for inspection')
+    parser.add_option('-v', '--verbose', action='store_true', help='show task output')
+    options, args = parser.parse_args()
+
+    parameters = dict([(k, getattr(options, k)) for k in [
+        'files', 'file_size', 'static_files', 'requirements', 'package_files', 'tables', 'rows', 'media_files', 'media_size'
+    ]])
+
+    answer_prompts()
+    runs = [run_all(options) for i in range(options.repeat)]
+
+    results = {}
+    for name in runs[0].keys():
+        errors = [r[name]['error'] for r in runs if 'error' in r[name]]
+        complete = [r[name] for r in runs if 'seconds' in r[name]]
+        results[name] = dict([(m, median([r[m] for r in complete])) for m in METRICS if complete])
+        if errors:
+            results[name]['error'] = errors[0]
+
+    baseline = {}
+    if os.path.exists(options.baseline):
+        saved = json.load(open(options.baseline))
+        baseline = saved['results']
+        if saved['parameters'] != parameters:
+            print('Warning: baseline was saved with other parameters: %s' % saved['parameters'])
+
+    order = [b[0] for b in get_benchmarks(None, None)]
+    report(results, baseline, order)
+
+    if options.save:
+        json.dump({'parameters': parameters, 'results': results}, open(options.baseline, 'w'), indent=1, sort_keys=True)
+        print('\nSaved baseline to %s' % options.baseline)
+        return 0
+
+    regressions = compare(results, baseline, options.threshold)
+    for name, metric, base_value, value in regressions:
+        print('Regression: %s %s %s => %s' % (name, metric, base_value, value))
+
+    failed = [n for n in results if 'error' in results[n]]
+    for name in failed:
+        print('Failed: %s (%s)' % (name, results[name]['error']))
+
+    return bool(regressions or failed) and 1 or 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,110 @@
+"""
+SQLite stand-in for the mysql, mysqldump and mysqladmin commands used by deploytool/scripts
+
+The database file is $BENCHMARK_DB. Only what the deploytool scripts need is
+emulated: engine/table listings from information_schema, dumps (optionally
+per table, without data or without create statements), loading SQL from
+stdin and dropping/creating the database. Statements SQLite doesn't know
+(SET, LOCK, ALTER ... ADD KEY, GRANT) are skipped.
+"""
+
+import os
+import sqlite3
+import sys
+
+
+def connect():
+
+    return sqlite3.connect(os.environ['BENCHMARK_DB'])
+
+
+def get_tables(connection):
+
+    rows = connection.execute("SELECT name FROM sqlite_master WHERE type = 'table' ORDER BY name")
+    return [r[0] for r in rows]
+
+
+def split_args(args):
+    """ Returns (options dict, positional args) for mysql style arguments """
+
+    options = {}
+    positional = []
+    for arg in args:
+        if arg.startswith('--'):
+            key, sep, value = arg[2:].partition('=')
+            options[key] = value.strip('"')
+        elif arg.startswith('-') and len(arg) > 1:
+            options[arg[1:]] = ''
+        else:
+            positional.append(arg)
+
+    return options, positional
+
+
+def execute_script(connection, sql):
+    """ Runs statements one by one, skipping what SQLite can't run """
+
+    statement = ''
+    for line in sql.splitlines(True):
+        statement += line
+        if not sqlite3.complete_statement(statement):
+            continue
+        try:
+            connection.execute(statement)
+        except sqlite3.Error:
+            pass
+        statement = ''
+
+    connection.commit()
+
+
+def mysql(args):
+
+    options, positional = split_args(args)
+    query = options.get('execute', options.get('e'))
+    connection = connect()
+
+    if query is None:
+        execute_script(connection, sys.stdin.read())
+    elif 'DISTINCT ENGINE' in query:
+        if get_tables(connection):
+            print('InnoDB')
+    elif 'information_schema' in query:
+        for table in get_tables(connection):
+            print('%s\tInnoDB' % table)
+    elif query.upper().startswith('SHOW'):
+        pass
+    else:
+        execute_script(connection, query)
+
+
+def mysqldump(args):
+
+    options, positional = split_args(args)
+    connection = connect()
+    tables = positional[1:] or get_tables(connection)
+
+    if 'no-create-info' in options and 'triggers' in options:
+        return
+
+    for table in tables:
+        if not 'no-create-info' in options:
+            sql = connection.execute("SELECT sql FROM sqlite_master WHERE name = ?", (table,)).fetchone()[0]
+            sys.stdout.write('%s;\n' % sql)
+        if not 'no-data' in options:
+            if not 'skip-comments' in options:
+                sys.stdout.write('--\n-- Dumping data for table `%s`\n--\n' % table)
+            columns = [c[1] for c in connection.execute('PRAGMA table_info("%s")' % table)]
+            select = 'SELECT %s FROM "%s"' % (str.join(', ', ["quote(%s)" % c for c in columns]), table)
+            for row in connection.execute(select):
+                sys.stdout.write('INSERT INTO "%s" VALUES(%s);\n' % (table, str.join(',', row)))
+
+
+def mysqladmin(args):
+
+    options, positional = split_args(args)
+
+    if positional[0] == 'drop' and os.path.exists(os.environ['BENCHMARK_DB']):
+        os.remove(os.environ['BENCHMARK_DB'])
+    elif positional[0] == 'create':
+        connect().close()
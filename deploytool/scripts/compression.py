@@ -0,0 +1,48 @@
+import json
+import os
+
+
+# compress/decompress commands and file extension by name, compress commands take a level
+COMPRESSORS = {
+	'none': ('cat', 'cat', ''),
+	'gzip': ('gzip -%d -c', 'gzip -d -c', '.gz'),
+	'xz': ('xz -%d -c', 'xz -d -c', '.xz'),
+	'zstd': ('zstd -%d -c -q', 'zstd -d -c -q', '.zst'),
+}
+
+
+def get_compression(file_path):
+	""" Returns compression name for file extension """
+
+	for name, (compress, decompress, extension) in COMPRESSORS.items():
+		if extension and file_path.endswith(extension):
+			return name
+
+	return 'none'
+
+
+def compress_command(compression, level=6):
+
+	compress = COMPRESSORS[compression][0]
+	if '%d' in compress:
+		compress = compress % int(level)
+
+	return compress
+
+
+def decompress_command(compression):
+
+	return COMPRESSORS[compression][1]
+
+
+def update_meta(file_path, **values):
+	""" Records values (timings, sizes) in a json file next to file_path """
+
+	meta_file = '%s.meta' % file_path
+	meta = {}
+
+	if os.path.exists(meta_file):
+		meta = json.load(open(meta_file))
+
+	meta.update(values)
+	json.dump(meta, open(meta_file, 'w'), indent=1, sort_keys=True)
@@ -1,14 +1,59 @@
+import os
 import subprocess
 import sys
+import time
 
+from compression import *
 from credentials import *
 
 
-command = 'mysqldump --user="%s" --password="%s" "%s" > %s' % (
+file_path = sys.argv[1]
+level = len(sys.argv) > 2 and sys.argv[2] or 6
+compression = get_compression(file_path)
+
+# a single transaction gives a consistent dump without locks, but only for transactional tables
+command = 'mysql --user="%s" --password="%s" --batch --skip-column-names --execute="%s"' % (
+	username,
+	password,
+	"SELECT DISTINCT ENGINE FROM information_schema.TABLES WHERE TABLE_SCHEMA = '%s' AND TABLE_TYPE = 'BASE TABLE'" % database
+)
+engines = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE).communicate()[0].split()
+
+if set(engines) <= set(['InnoDB']):
+	options = '--single-transaction --quick'
+else:
+	options = '--lock-tables --quick'
+
+command = 'mysqldump %s --user="%s" --password="%s" "%s"' % (
+	options,
 	username,
 	password,
-	database,
-	sys.argv[1]
+	database
+)
+
+start = time.time()
+raw_bytes = 0
+dump = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE)
+compressor = subprocess.Popen(compress_command(compression, level), shell=True, stdin=subprocess.PIPE, stdout=open(file_path, 'wb'))
+
+# stream dump through compressor, counting the uncompressed size
+while True:
+	chunk = dump.stdout.read(64 * 1024)
+	if not chunk:
+		break
+	compressor.stdin.write(chunk)
+	raw_bytes += len(chunk)
+
+compressor.stdin.close()
+dump_status = dump.wait()
+compress_status = compressor.wait()
+
+update_meta(file_path,
+	backup_seconds=round(time.time() - start, 2),
+	backup_options=options,
+	compression=compression,
+	raw_bytes=raw_bytes,
+	bytes=os.path.getsize(file_path)
 )
 
-subprocess.call(command, shell=True)
\ No newline at end of file
+sys.exit(dump_status or compress_status)
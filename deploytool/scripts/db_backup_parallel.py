@@ -0,0 +1,148 @@
+"""
+Parallel backup: one compressed file per table, plus schema, triggers and a manifest
+
+	usage: db_backup_parallel.py PATH [LEVEL] [JOBS] [COMPRESSION]
+
+All data comes from one mysqldump run in a single transaction (or with all
+tables locked at once when some are not transactional), so the tables are a
+snapshot of one point in time, like the single file backups. The dump is
+split into one file per table as it streams by, and up to JOBS tables are
+compressed at once.
+"""
+
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+
+from compression import *
+from credentials import *
+
+
+backup_path = sys.argv[1]
+level = len(sys.argv) > 2 and sys.argv[2] or 6
+jobs = int(len(sys.argv) > 3 and sys.argv[3] or 4)
+compression = len(sys.argv) > 4 and sys.argv[4] or 'gzip'
+
+credentials = '--user="%s" --password="%s"' % (username, password)
+extension = COMPRESSORS[compression][2]
+
+os.makedirs(os.path.join(backup_path, 'tables'))
+start = time.time()
+
+command = 'mysql %s --batch --skip-column-names --execute="%s"' % (
+	credentials,
+	"SELECT TABLE_NAME, ENGINE FROM information_schema.TABLES WHERE TABLE_SCHEMA = '%s' AND TABLE_TYPE = 'BASE TABLE'" % database
+)
+output = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE).communicate()[0]
+tables = [line.split('\t') for line in output.splitlines() if line.strip()]
+
+# schema and triggers are restored separately from (before/after) the data
+status = subprocess.call('mysqldump %s --no-data --skip-triggers --skip-comments "%s" > %s' % (
+	credentials,
+	database,
+	os.path.join(backup_path, 'schema.sql')
+), shell=True)
+status = status or subprocess.call('mysqldump %s --no-data --no-create-info --skip-comments --triggers "%s" > %s' % (
+	credentials,
+	database,
+	os.path.join(backup_path, 'triggers.sql')
+), shell=True)
+
+manifest = {
+	'format': 1,
+	'database': database,
+	'compression': compression,
+	'schema': 'schema.sql',
+	'triggers': 'triggers.sql',
+	'jobs': jobs,
+	'tables': [],
+}
+
+# a transaction (or lock) per mysqldump run, so all tables come from one run
+if set([engine for table, engine in tables]) <= set(['InnoDB']):
+	options = '--single-transaction --quick'
+else:
+	options = '--lock-tables --quick'
+
+dump = subprocess.Popen('mysqldump %s %s --no-create-info --skip-triggers "%s"' % (
+	options,
+	credentials,
+	database
+), shell=True, stdout=subprocess.PIPE)
+
+# data of every table starts with this comment, lines before the first one set up the session
+table_start = re.compile(r'^-- Dumping data for table `(.*)`')
+header = []
+current = None
+compressing = []
+failures = []
+
+
+def finish_table(entry):
+	""" Waits for compressor of table and records it in the manifest """
+
+	if entry['compressor'].wait() != 0:
+		failures.append(entry['name'])
+	manifest['tables'].append({
+		'name': entry['name'],
+		'file': entry['file'],
+		'bytes': os.path.getsize(os.path.join(backup_path, entry['file'])),
+		'seconds': round(time.time() - entry['started'], 2),
+	})
+
+
+def start_table(name):
+	""" Returns entry for table with a new compressor process, which gets the session header first """
+
+	# compress at most `jobs` tables at once
+	while len(compressing) >= jobs:
+		finish_table(compressing.pop(0))
+
+	file_name = os.path.join('tables', '%s.sql%s' % (name, extension))
+	compressor = subprocess.Popen(compress_command(compression, level), shell=True,
+		stdin=subprocess.PIPE, stdout=open(os.path.join(backup_path, file_name), 'wb'))
+	compressor.stdin.write(str.join('', header))
+
+	return {'name': name, 'file': file_name, 'compressor': compressor, 'started': time.time()}
+
+
+for line in iter(dump.stdout.readline, ''):
+	match = table_start.match(line)
+	if match:
+		if current:
+			current['compressor'].stdin.close()
+			compressing.append(current)
+		current = start_table(match.group(1).replace('``', '`'))
+	if current:
+		current['compressor'].stdin.write(line)
+	else:
+		header.append(line)
+
+if current:
+	current['compressor'].stdin.close()
+	compressing.append(current)
+for entry in compressing:
+	finish_table(entry)
+
+# tables without data section (none expected) still get a file, so every table is restored
+dumped = [t['name'] for t in manifest['tables']]
+for table, engine in tables:
+	if not table in dumped:
+		entry = start_table(table)
+		entry['compressor'].stdin.close()
+		finish_table(entry)
+
+if dump.wait() != 0:
+	failures.append('mysqldump')
+
+manifest['tables'].sort(key=lambda t: t['name'])
+manifest['backup_seconds'] = round(time.time() - start, 2)
+manifest['bytes'] = sum([t['bytes'] for t in manifest['tables']])
+manifest['failed_tables'] = failures
+
+json.dump(manifest, open(os.path.join(backup_path, 'manifest.json'), 'w'), indent=1, sort_keys=True)
+
+sys.exit(status or len(failures) and 1)
@@ -0,0 +1,151 @@
+"""
+Restore a backup made by db_backup_parallel.py into an empty database
+
+	usage: db_restore_parallel.py PATH [JOBS]
+
+Tables are created without secondary indexes and foreign keys, data is
+loaded over JOBS connections at once, then indexes are added per table
+(also in parallel) and foreign keys last.
+"""
+
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import threading
+import time
+import Queue
+
+from compression import *
+from credentials import *
+
+
+backup_path = sys.argv[1]
+jobs = int(len(sys.argv) > 2 and sys.argv[2] or 4)
+
+manifest_file = os.path.join(backup_path, 'manifest.json')
+manifest = json.load(open(manifest_file))
+mysql = 'mysql --user="%s" --password="%s" --database="%s"' % (username, password, database)
+deferred_key = re.compile(r'^\s*(UNIQUE KEY|KEY|FULLTEXT KEY|SPATIAL KEY|CONSTRAINT)\s')
+
+
+def split_schema(schema):
+	"""
+	Returns schema without deferred keys, and dicts of table => [index definitions]
+	and table => [constraint definitions]
+	"""
+
+	lines = []
+	indexes = {}
+	constraints = {}
+	table = None
+	auto_increment = []
+
+	for line in schema.splitlines():
+		match = re.match(r'^CREATE TABLE `([^`]+)`', line)
+		if match:
+			table = match.group(1)
+			auto_increment = []
+		elif table and line.startswith(')'):
+			table = None
+			# the last remaining definition must not end with a comma
+			lines[-1] = lines[-1].rstrip(',')
+		elif table and 'AUTO_INCREMENT' in line:
+			auto_increment.append(line.strip().split(' ')[0])
+		elif table and deferred_key.match(line):
+			definition = line.strip().rstrip(',')
+			columns = definition[definition.index('('):]
+			if definition.startswith('CONSTRAINT'):
+				constraints.setdefault(table, []).append(definition)
+				continue
+			# keys on auto increment columns are required at creation time
+			if not [c for c in auto_increment if c in columns]:
+				indexes.setdefault(table, []).append(definition)
+				continue
+
+		lines.append(line)
+
+	return str.join('\n', lines), indexes, constraints
+
+
+def execute(sql):
+
+	process = subprocess.Popen(mysql, shell=True, stdin=subprocess.PIPE)
+	process.communicate(sql)
+	return process.returncode
+
+
+def run_parallel(func, items):
+	""" Calls func(item) for all items using `jobs` threads, returns failed items """
+
+	queue = Queue.Queue()
+	failures = []
+	for item in items:
+		queue.put(item)
+
+	def work():
+		while True:
+			try:
+				item = queue.get_nowait()
+			except Queue.Empty:
+				return
+			if func(item) != 0:
+				failures.append(item)
+
+	threads = [threading.Thread(target=work) for i in range(jobs)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+
+	return failures
+
+
+def load_table(table):
+	""" Loads data of table, fails when mysql or the decompressor fails (e.g. for a truncated file) """
+
+	decompressor = subprocess.Popen(
+		decompress_command(manifest['compression']),
+		shell=True,
+		stdin=open(os.path.join(backup_path, table['file']), 'rb'),
+		stdout=subprocess.PIPE
+	)
+	loader = subprocess.Popen(mysql, shell=True, stdin=subprocess.PIPE)
+
+	loader.stdin.write('SET foreign_key_checks = 0; SET unique_checks = 0;\n')
+	shutil.copyfileobj(decompressor.stdout, loader.stdin, 1024 * 1024)
+	loader.stdin.close()
+
+	loader_status = loader.wait()
+	decompress_status = decompressor.wait()
+
+	return loader_status or decompress_status
+
+
+def add_indexes(table):
+
+	return execute('ALTER TABLE `%s` %s;' % (table, str.join(', ', ['ADD %s' % d for d in indexes[table]])))
+
+
+start = time.time()
+schema, indexes, constraints = split_schema(open(os.path.join(backup_path, manifest['schema'])).read())
+
+status = execute(schema)
+failures = run_parallel(load_table, manifest['tables'])
+failures += run_parallel(add_indexes, sorted(indexes.keys()))
+
+# foreign keys need the indexes of both tables
+sql = ['SET foreign_key_checks = 0;']
+for table in sorted(constraints.keys()):
+	sql.append('ALTER TABLE `%s` %s;' % (table, str.join(', ', ['ADD %s' % d for d in constraints[table]])))
+status = status or execute(str.join('\n', sql))
+
+status = status or execute(open(os.path.join(backup_path, manifest['triggers'])).read())
+
+manifest['restore_seconds'] = round(time.time() - start, 2)
+manifest['restore_failures'] = [str(f) for f in failures]
+json.dump(manifest, open(manifest_file, 'w'), indent=1, sort_keys=True)
+
+sys.exit(status or len(failures) and 1)
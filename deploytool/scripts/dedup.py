@@ -0,0 +1,158 @@
+"""
+Deduplicate files of instances by hardlinking them to a per-project store
+
+	usage: dedup.py link STORE INSTANCE_PATH [MIN_SIZE]
+	       dedup.py gc STORE
+
+link: regular files of at least MIN_SIZE bytes (default 1024) in
+INSTANCE_PATH, except bytecode, are keyed by size, SHA1 and mode. The first
+file with a key becomes the blob STORE/<sha1[:2]>/<sha1>-<size>-<mode> (by
+hardlink, nothing is copied), later files with the same key are replaced by
+a hardlink to the blob.
+STORE/index.json maps blob inodes to keys, so files that already are a blob
+(e.g. seeded or cloned by hardlink from an earlier instance) are not hashed
+again.
+
+gc: the link count of a blob is its reference count, blobs with no other
+links left (all instances using them were removed) are deleted.
+
+Both hold an exclusive lock on STORE/lock while they run, so a gc in the
+background (after pruning) never overlaps with linking the next instance.
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+import stat
+import sys
+
+
+def hash_file(path):
+
+	sha1 = hashlib.sha1()
+	source = open(path, 'rb')
+	while True:
+		chunk = source.read(1024 * 1024)
+		if not chunk:
+			break
+		sha1.update(chunk)
+	source.close()
+
+	return sha1.hexdigest()
+
+
+def get_blob_path(store_path, key):
+
+	return os.path.join(store_path, key[:2], key)
+
+
+def load_index(store_path):
+
+	index_file = os.path.join(store_path, 'index.json')
+	if os.path.exists(index_file):
+		return json.load(open(index_file))
+
+	return {}
+
+
+def save_index(store_path, index):
+
+	index_file = os.path.join(store_path, 'index.json')
+	json.dump(index, open('%s.tmp' % index_file, 'w'))
+	os.rename('%s.tmp' % index_file, index_file)
+
+
+def lock_store(store_path):
+	""" Returns open lock file, the lock is held until it is closed (or the process exits) """
+
+	lock = open(os.path.join(store_path, 'lock'), 'w')
+	fcntl.flock(lock, fcntl.LOCK_EX)
+
+	return lock
+
+
+def link(store_path, instance_path, min_size=1024):
+
+	if not os.path.exists(store_path):
+		os.makedirs(store_path)
+
+	lock = lock_store(store_path)
+	index = load_index(store_path)
+	files = 0
+	hashed = 0
+	linked = 0
+	saved_bytes = 0
+
+	for root, dirs, names in os.walk(instance_path):
+		for name in names:
+			# Python rewrites bytecode in place, which would change every linked copy
+			if name.endswith(('.pyc', '.pyo')):
+				continue
+
+			path = os.path.join(root, name)
+			info = os.lstat(path)
+			if not stat.S_ISREG(info.st_mode) or info.st_size < min_size:
+				continue
+			files += 1
+
+			# already a blob (inode is checked, inodes of removed blobs get reused)
+			inode = '%d:%d' % (info.st_dev, info.st_ino)
+			key = index.get(inode)
+			if key and os.path.exists(get_blob_path(store_path, key)) and os.stat(get_blob_path(store_path, key)).st_ino == info.st_ino:
+				continue
+
+			key = '%s-%d-%o' % (hash_file(path), info.st_size, stat.S_IMODE(info.st_mode))
+			blob_path = get_blob_path(store_path, key)
+			hashed += 1
+
+			if os.path.exists(blob_path):
+				# replace file by blob, in one rename
+				os.link(blob_path, '%s.dedup' % path)
+				os.rename('%s.dedup' % path, path)
+				linked += 1
+				saved_bytes += info.st_size
+			else:
+				if not os.path.exists(os.path.dirname(blob_path)):
+					os.makedirs(os.path.dirname(blob_path))
+				os.link(path, blob_path)
+				index[inode] = key
+
+	save_index(store_path, index)
+	lock.close()
+	print('%d files, %d hashed, %d replaced by hardlinks (%d bytes saved)' % (files, hashed, linked, saved_bytes))
+
+
+def gc(store_path):
+
+	if not os.path.exists(store_path):
+		return
+
+	lock = lock_store(store_path)
+	index = load_index(store_path)
+	removed = 0
+	removed_bytes = 0
+
+	for inode, key in index.items():
+		blob_path = get_blob_path(store_path, key)
+		if not os.path.exists(blob_path):
+			del index[inode]
+			continue
+
+		info = os.stat(blob_path)
+		if info.st_nlink <= 1:
+			os.remove(blob_path)
+			del index[inode]
+			removed += 1
+			removed_bytes += info.st_size
+
+	save_index(store_path, index)
+	lock.close()
+	print('removed %d unreferenced files from store (%d bytes)' % (removed, removed_bytes))
+
+
+if __name__ == '__main__':
+	if sys.argv[1] == 'link':
+		link(sys.argv[2], sys.argv[3], int(len(sys.argv) > 4 and sys.argv[4] or 1024))
+	elif sys.argv[1] == 'gc':
+		gc(sys.argv[2])
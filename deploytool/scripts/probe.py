@@ -0,0 +1,84 @@
+"""
+Print status of a project as one JSON object (for the status task)
+
+	usage: python - PROJECT_PATH [RECORD_LINES] < probe.py
+
+Reports current/previous/staged instances with their sizes, media size,
+free disk space, load average, the active blue/green backend and the last
+RECORD_LINES (default 100) lines of log/fabric.jsonl and log/fabric.log.
+Sizes are read from the size index (see size_index.py) instead of walking
+folders, they are null for folders missing from it.
+"""
+
+import json
+import os
+import re
+import subprocess
+import sys
+
+
+project_path = sys.argv[1]
+record_lines = int(len(sys.argv) > 2 and sys.argv[2] or 100)
+
+
+def read_link(name):
+
+	path = os.path.join(project_path, name)
+	return os.path.islink(path) and os.readlink(path) or None
+
+
+def tail(name, lines):
+
+	path = os.path.join(project_path, 'log', name)
+	if not os.path.exists(path):
+		return []
+	output = subprocess.Popen(['tail', '-n', str(lines), path], stdout=subprocess.PIPE).communicate()[0]
+	return output.splitlines()
+
+
+def load_size_index():
+
+	try:
+		return json.load(open(os.path.join(project_path, '.sizes.json')))
+	except (IOError, ValueError):
+		return {'areas': {}}
+
+
+current = read_link('current_instance')
+previous = read_link('previous_instance')
+
+# instances are named by 40 character commit ID, newest (by ctime) first
+names = [n for n in os.listdir(project_path) if re.match(r'^[0-9a-f]{40}$', n)]
+names.sort(key=lambda n: -os.stat(os.path.join(project_path, n)).st_ctime)
+size_index = load_size_index()
+sizes = dict([(a, v['size']) for a, v in size_index['areas'].items()])
+
+instances = []
+for name in names:
+	path = os.path.join(project_path, name)
+	role = None
+	if current and current.rstrip('/').endswith(name):
+		role = 'current'
+	elif previous and previous.rstrip('/').endswith(name):
+		role = 'previous'
+	elif os.path.exists(os.path.join(path, 'staged')):
+		role = 'staged'
+	instances.append({'stamp': name, 'role': role, 'size': sizes.get(name)})
+
+disk = os.statvfs(project_path)
+upstream = read_link(os.path.join('nginx', 'upstream.conf'))
+
+print(json.dumps({
+	'current': current and current.rstrip('/')[-40:],
+	'previous': previous and previous.rstrip('/')[-40:],
+	'instances': instances,
+	'media_size': sizes.get('media'),
+	'total_size': size_index['areas'] and sum(sizes.values()) or None,
+	'sizes_updated': size_index.get('updated'),
+	'disk_free': disk.f_bavail * disk.f_frsize,
+	'disk_total': disk.f_blocks * disk.f_frsize,
+	'load': os.getloadavg(),
+	'active_backend': upstream and upstream.replace('.conf', ''),
+	'records': tail('fabric.jsonl', record_lines),
+	'fabric_log': tail('fabric.log', 5),
+}))
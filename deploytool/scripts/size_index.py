@@ -0,0 +1,166 @@
+"""
+Keep an index of disk usage per top-level folder (area) of a project
+
+	usage: size_index.py PROJECT_PATH refresh [AREA ...]
+	       size_index.py PROJECT_PATH rebuild
+
+Every folder in PROJECT_PATH (each instance, media, cache, log, stores) is an
+area. PROJECT_PATH/.sizes/<area>.json caches mtime, size and subfolders of
+each folder in the area, PROJECT_PATH/.sizes.json holds the totals per area,
+so readers (see probe.py) get all sizes from one small file.
+
+refresh: rescans the given areas (default all), only listing folders whose
+mtime changed since the last scan. Unchanged folders cost one stat instead of
+one per file, so large media folders are cheap to keep up to date. Areas that
+no longer exist are dropped.
+Files changed in place (without creating, renaming or removing entries) do
+not change the mtime of their folder, so their new size shows after the next
+rebuild. The log area only grows by appending to its files, so it is always
+rescanned (it has few files).
+
+rebuild: rescans every folder of all areas.
+
+Sizes are disk usage (blocks) like du, a file with several hardlinks counts
+for 1/nlinks in every folder that links to it. Prints the totals as JSON.
+"""
+
+import fcntl
+import json
+import os
+import stat
+import sys
+import time
+
+
+project_path = sys.argv[1]
+command = sys.argv[2]
+requested_areas = sys.argv[3:]
+
+index_path = os.path.join(project_path, '.sizes')
+summary_file = os.path.join(project_path, '.sizes.json')
+
+# folders modified this recently may change again within mtime resolution, these are always rescanned
+SETTLE_SECONDS = 2
+
+# areas whose files only grow by appending (which doesn't change folder mtimes), these are always rescanned
+APPEND_ONLY_AREAS = ['log']
+
+
+def load(path, default):
+
+	try:
+		return json.load(open(path))
+	except (IOError, ValueError):
+		return default
+
+
+def save(path, data):
+
+	json.dump(data, open('%s.tmp' % path, 'w'))
+	os.rename('%s.tmp' % path, path)
+
+
+def get_areas():
+	""" Returns names of all folders in project, except the index itself """
+
+	areas = []
+	for name in os.listdir(project_path):
+		if name in ['.sizes']:
+			continue
+		if stat.S_ISDIR(os.lstat(os.path.join(project_path, name)).st_mode):
+			areas.append(name)
+
+	return areas
+
+
+def scan_folder(path, st):
+	""" Returns [mtime, size, files, subfolders] of a folder, not counting its subfolders """
+
+	size = st.st_blocks * 512
+	files = 0
+	subfolders = []
+	for name in os.listdir(path):
+		try:
+			file_st = os.lstat(os.path.join(path, name))
+		except OSError:
+			continue
+		if stat.S_ISDIR(file_st.st_mode):
+			subfolders.append(name)
+		else:
+			files += 1
+			size += file_st.st_blocks * 512 // max(file_st.st_nlink, 1)
+
+	mtime = st.st_mtime
+	if time.time() - mtime < SETTLE_SECONDS:
+		mtime = None
+
+	return [mtime, size, files, subfolders]
+
+
+def scan_area(area, folders):
+	""" Returns folders of area (relative path => [mtime, size, files, subfolders]), reusing unchanged ones """
+
+	area_path = os.path.join(project_path, area)
+	scanned = {}
+	pending = ['']
+	rescanned = 0
+	while pending:
+		relative_path = pending.pop()
+		path = os.path.join(area_path, relative_path)
+		try:
+			st = os.lstat(path)
+		except OSError:
+			continue
+
+		folder = folders.get(relative_path)
+		if not folder or folder[0] != st.st_mtime or area in APPEND_ONLY_AREAS:
+			try:
+				folder = scan_folder(path, st)
+			except OSError:
+				continue
+			rescanned += 1
+
+		scanned[relative_path] = folder
+		pending.extend([os.path.join(relative_path, n) for n in folder[3]])
+
+	return scanned, rescanned
+
+
+if not command in ['refresh', 'rebuild']:
+	sys.exit(__doc__)
+
+if not os.path.exists(index_path):
+	os.mkdir(index_path)
+
+# a background refresh (after pruning) may run alongside a deploy
+lock = open(os.path.join(index_path, 'lock'), 'w')
+fcntl.flock(lock, fcntl.LOCK_EX)
+
+existing_areas = get_areas()
+summary = load(summary_file, {'areas': {}})
+areas = [a for a in requested_areas or existing_areas if a in existing_areas]
+
+for area in list(summary['areas'].keys()):
+	if not area in existing_areas:
+		del summary['areas'][area]
+		if os.path.exists(os.path.join(index_path, '%s.json' % area)):
+			os.remove(os.path.join(index_path, '%s.json' % area))
+
+for area in areas:
+	area_file = os.path.join(index_path, '%s.json' % area)
+	folders = command == 'refresh' and load(area_file, {}) or {}
+	folders, rescanned = scan_area(area, folders)
+	save(area_file, folders)
+
+	summary['areas'][area] = {
+		'size': sum([f[1] for f in folders.values()]),
+		'files': sum([f[2] for f in folders.values()]),
+		'folders': len(folders),
+		'rescanned': rescanned,
+		'updated': int(time.time()),
+	}
+
+summary['updated'] = int(time.time())
+save(summary_file, summary)
+
+print(json.dumps(summary))
@@ -0,0 +1,79 @@
+"""
+Measure response times and errors of a website
+
+	usage: smoke_test.py PORT HOST REQUESTS CONCURRENCY URL [URL ...]
+
+Sends REQUESTS requests (URLs in turn) to 127.0.0.1:PORT with HOST as Host
+header, CONCURRENCY at a time, and prints one JSON line with the number of
+requests, error rate (connection failures and 5xx responses) and p50/p95
+response time in seconds.
+"""
+
+import httplib
+import json
+import sys
+import threading
+import time
+import Queue
+
+
+port = int(sys.argv[1])
+host = sys.argv[2]
+requests = int(sys.argv[3])
+concurrency = int(sys.argv[4])
+urls = sys.argv[5:] or ['/']
+
+
+def request(url):
+	""" Returns (seconds, True if failed) """
+
+	start = time.time()
+	try:
+		connection = httplib.HTTPConnection('127.0.0.1', port, timeout=60)
+		connection.request('GET', url, headers={'Host': host})
+		response = connection.getresponse()
+		response.read()
+		connection.close()
+	except Exception:
+		return time.time() - start, True
+
+	return time.time() - start, response.status >= 500
+
+
+def worker(queue, results):
+
+	while True:
+		try:
+			url = queue.get_nowait()
+		except Queue.Empty:
+			return
+		results.append(request(url))
+
+
+def percentile(values, percent):
+	""" Nearest-rank percentile """
+
+	values = sorted(values)
+	index = int(round(percent / 100.0 * len(values) + 0.5)) - 1
+
+	return values[max(0, min(index, len(values) - 1))]
+
+
+queue = Queue.Queue()
+for index in range(requests):
+	queue.put(urls[index % len(urls)])
+
+results = []
+threads = [threading.Thread(target=worker, args=(queue, results)) for i in range(concurrency)]
+for thread in threads:
+	thread.start()
+for thread in threads:
+	thread.join()
+
+times = [r[0] for r in results]
+print(json.dumps({
+	'requests': len(results),
+	'error_rate': round(len([r for r in results if r[1]]) / float(max(len(results), 1)), 4),
+	'p50': round(percentile(times or [0], 50), 4),
+	'p95': round(percentile(times or [0], 95), 4),
+}))
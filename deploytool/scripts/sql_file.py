@@ -1,14 +1,35 @@
 import subprocess
 import sys
+import time
 
+from compression import *
 from credentials import *
 
 
-command = 'mysql --user="%s" --password="%s" --database="%s" < %s' % (
-	username,
-	password,
-	database,
-	sys.argv[1]
+file_path = sys.argv[1]
+
+# decompressor and mysql run as separate processes, so a truncated or corrupt backup fails the restore
+start = time.time()
+decompressor = subprocess.Popen(
+	decompress_command(get_compression(file_path)),
+	shell=True,
+	stdin=open(file_path, 'rb'),
+	stdout=subprocess.PIPE
+)
+mysql = subprocess.Popen(
+	'mysql --user="%s" --password="%s" --database="%s"' % (username, password, database),
+	shell=True,
+	stdin=decompressor.stdout
+)
+decompressor.stdout.close()
+
+mysql_status = mysql.wait()
+decompress_status = decompressor.wait()
+status = mysql_status or decompress_status
+
+update_meta(file_path,
+	restore_seconds=round(time.time() - start, 2),
+	restore_status=status
 )
 
-subprocess.call(command, shell=True)
\ No newline at end of file
+sys.exit(status)
@@ -0,0 +1,149 @@
+"""
+Content-addressed store for static files, shared by all instances of a project
+
+	usage: static_store.py link STORE STATIC_PATH MANIFEST [PREVIOUS_MANIFEST] [--symlink]
+	       static_store.py gc STORE PROJECT_PATH
+
+link: every file in STATIC_PATH (symlinks are followed, like the ones made by
+`collectstatic --link`) is stored once as STORE/<sha1[:2]>/<sha1> and replaced
+by a hardlink (or symlink) to it. MANIFEST records path => sha1, and the
+source file (device, inode, size, mtime) => sha1, so files that are unchanged
+since PREVIOUS_MANIFEST (e.g. seeded by hardlink) are not hashed again.
+
+gc: removes blobs from STORE that no PROJECT_PATH/*/static.manifest refers to.
+
+Both hold an exclusive lock on STORE/lock while they run, so a gc in the
+background (after pruning) never removes blobs of an instance being linked.
+"""
+
+import fcntl
+import glob
+import hashlib
+import json
+import os
+import shutil
+import sys
+
+
+def get_blob_path(store_path, file_hash):
+
+	return os.path.join(store_path, file_hash[:2], file_hash)
+
+
+def get_source_key(path):
+
+	stat = os.stat(path)
+	return '%d:%d:%d:%d' % (stat.st_dev, stat.st_ino, stat.st_size, int(stat.st_mtime))
+
+
+def hash_file(path):
+
+	sha1 = hashlib.sha1()
+	source = open(path, 'rb')
+	while True:
+		chunk = source.read(1024 * 1024)
+		if not chunk:
+			break
+		sha1.update(chunk)
+	source.close()
+
+	return sha1.hexdigest()
+
+
+def load_manifest(path):
+
+	if path and os.path.exists(path):
+		return json.load(open(path))
+
+	return {'files': {}, 'sources': {}}
+
+
+def replace(path, blob_path, symlink):
+	""" Replaces path by a link to blob_path, in one rename """
+
+	temporary_path = '%s.static_store' % path
+	if symlink:
+		os.symlink(blob_path, temporary_path)
+	else:
+		os.link(blob_path, temporary_path)
+	os.rename(temporary_path, path)
+
+
+def lock_store(store_path):
+	""" Returns open lock file, the lock is held until it is closed (or the process exits) """
+
+	lock = open(os.path.join(store_path, 'lock'), 'w')
+	fcntl.flock(lock, fcntl.LOCK_EX)
+
+	return lock
+
+
+def link(store_path, static_path, manifest_file, previous_manifest_file=None, symlink=False):
+
+	if not os.path.exists(store_path):
+		os.makedirs(store_path)
+
+	lock = lock_store(store_path)
+	previous = load_manifest(previous_manifest_file)
+	manifest = {'files': {}, 'sources': {}}
+	hashed = 0
+	stored = 0
+	stored_bytes = 0
+
+	for root, dirs, files in os.walk(static_path, followlinks=True):
+		for name in files:
+			path = os.path.join(root, name)
+			source_key = get_source_key(path)
+
+			file_hash = previous['sources'].get(source_key)
+			if not file_hash:
+				file_hash = hash_file(path)
+				hashed += 1
+
+			blob_path = get_blob_path(store_path, file_hash)
+			if not os.path.exists(blob_path):
+				if not os.path.exists(os.path.dirname(blob_path)):
+					os.makedirs(os.path.dirname(blob_path))
+				shutil.copyfile(path, '%s.tmp' % blob_path)
+				os.rename('%s.tmp' % blob_path, blob_path)
+				stored += 1
+				stored_bytes += os.path.getsize(blob_path)
+
+			replace(path, blob_path, symlink)
+			manifest['files'][os.path.relpath(path, static_path)] = file_hash
+			manifest['sources'][source_key] = file_hash
+
+	json.dump(manifest, open(manifest_file, 'w'))
+	lock.close()
+	print('%d static files, %d hashed, %d new in store (%d bytes)' % (len(manifest['files']), hashed, stored, stored_bytes))
+
+
+def gc(store_path, project_path):
+
+	if not os.path.exists(store_path):
+		return
+
+	lock = lock_store(store_path)
+	referenced = set()
+	for manifest_file in glob.glob(os.path.join(project_path, '*', 'static.manifest')):
+		referenced.update(load_manifest(manifest_file)['files'].values())
+
+	removed = 0
+	removed_bytes = 0
+	for blob_path in glob.glob(os.path.join(store_path, '*', '*')):
+		if not os.path.basename(blob_path) in referenced:
+			removed_bytes += os.path.getsize(blob_path)
+			os.remove(blob_path)
+			removed += 1
+
+	lock.close()
+	print('removed %d unreferenced static files (%d bytes)' % (removed, removed_bytes))
+
+
+if __name__ == '__main__':
+	args = [a for a in sys.argv[1:] if a != '--symlink']
+
+	if args[0] == 'link':
+		link(args[1], args[2], args[3], len(args) > 4 and args[4] or None, '--symlink' in sys.argv)
+	elif args[0] == 'gc':
+		gc(args[1], args[2])
@@ -0,0 +1,71 @@
+"""
+Warm up a backend by requesting URLs until response times settle
+
+	usage: warmup.py PORT HOST ROUNDS TOLERANCE URL [URL ...]
+
+Every round requests all URLs once from 127.0.0.1:PORT with HOST as Host
+header. Warm-up is done when the median response time of a round is within
+TOLERANCE (0.2 is 20%) of the previous round. Exits with status 1 when the
+last round still had errors (connection failures or 5xx responses).
+"""
+
+import httplib
+import sys
+import time
+
+
+port = int(sys.argv[1])
+host = sys.argv[2]
+rounds = int(sys.argv[3])
+tolerance = float(sys.argv[4])
+urls = sys.argv[5:] or ['/']
+
+
+def request(url):
+	""" Returns (seconds, error message or None) """
+
+	start = time.time()
+	try:
+		connection = httplib.HTTPConnection('127.0.0.1', port, timeout=60)
+		connection.request('GET', url, headers={'Host': host})
+		response = connection.getresponse()
+		response.read()
+		connection.close()
+	except Exception, e:
+		return time.time() - start, str(e)
+
+	if response.status >= 500:
+		return time.time() - start, 'HTTP %d' % response.status
+
+	return time.time() - start, None
+
+
+previous_median = None
+errors = []
+
+for number in range(1, rounds + 1):
+	times = []
+	errors = []
+	for url in urls:
+		seconds, error = request(url)
+		times.append(seconds)
+		if error:
+			errors.append('%s: %s' % (url, error))
+
+	median = sorted(times)[len(times) // 2]
+	print('round %d: median %.0f ms, %d errors' % (number, median * 1000, len(errors)))
+
+	if errors:
+		# backend may still be starting
+		time.sleep(1)
+	elif previous_median is not None and abs(median - previous_median) <= tolerance * previous_median:
+		print('settled')
+		sys.exit(0)
+
+	previous_median = not errors and median or None
+
+if errors:
+	print(str.join('\n', errors))
+	sys.exit(1)
+
+print('not settled after %d rounds' % rounds)
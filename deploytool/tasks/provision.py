@@ -6,8 +6,10 @@ from fabric.contrib.console import confirm
 from fabric.operations import require
 from fabric.tasks import Task
 import os
+import time
 
 import deploytool
+import deploytool.utils as utils
 
 class ProvisioningTask(Task):
     """
@@ -18,9 +20,10 @@ class ProvisioningTask(Task):
         - uses provisioning_user to connect
         - uses sudo for remote commands
         - calls task implementation
+        - traces remote operations without running them for `fab setup:trace=1`
     """
 
-    def run(self):
+    def run(self, *args, **kwargs):
 
         # check if all required project and host settings are present in fabric environment
         [require(r) for r in self.requirements]
@@ -32,12 +35,29 @@ class ProvisioningTask(Task):
             # make sure local user either knows remote password, or has its local public key on remote end
             print(green('\nConnecting with user %s ' % magenta(env.provisioning_user)))
             env.update({'user': env.provisioning_user})
+            utils.network.preconnect(env.all_hosts)
 
             # ask for sudo session up front
             sudo('ls')
 
             # call task implementation in subclass
-            self()
+            start = time.time()
+            success = False
+            utils.records.start(self.name)
+
+            # trace=1 records remote operations instead of running them, see utils.trace
+            trace = kwargs.get('trace')
+            if trace:
+                utils.trace.start()
+
+            try:
+                self()
+                success = True
+            finally:
+                utils.network.record_task(self.name, time.time() - start)
+                utils.records.finish(success, use_sudo=True)
+                if trace:
+                    utils.trace.stop()
 
     def __call__(self):
 
@@ -101,12 +121,14 @@ class Setup(ProvisioningTask):
         local_templates_path = os.path.join(os.path.dirname(deploytool.__file__), 'templates')
 
         # locations of remote paths
-        user_home_path = os.path.join('/', 'home', project_user)
+        user_home_path = os.path.join(getattr(env, 'home_root', '/home'), project_user)
         user_ssh_path = os.path.join(user_home_path, '.ssh')
         auth_keys_file = os.path.join(user_ssh_path, 'authorized_keys')
         htpasswd_path = os.path.join(env.project_path, 'htpasswd')
-        apache_conf_path = os.path.join('/', 'etc', 'httpd', 'conf.d')
-        nginx_conf_path = os.path.join('/', 'etc', 'nginx', 'conf.d')
+        apache_conf_path = getattr(env, 'apache_conf_path', os.path.join('/', 'etc', 'httpd', 'conf.d'))
+        nginx_conf_path = getattr(env, 'nginx_conf_path', os.path.join('/', 'etc', 'nginx', 'conf.d'))
+        init_path = getattr(env, 'init_path', os.path.join('/', 'etc', 'init.d'))
+        blue_green = getattr(env, 'blue_green', False)
 
         # check for existing project root/path, and abort if found
         if not exists(env.project_root, use_sudo=True):
@@ -120,7 +142,7 @@ class Setup(ProvisioningTask):
             abort(red('\nProvisioning cancelled.'))
 
         # [1] create new project_user
-        print(green('\nCreating project user `%s` ' % project_user))
+        utils.records.step('Creating project user `%s` ' % project_user)
         user_exists = bool(run('cat /etc/passwd').find(project_user) > 0)
 
         if user_exists:
@@ -147,7 +169,7 @@ class Setup(ProvisioningTask):
         sudo('chown -R %s:%s %s' % (project_user, project_user, user_home_path))
 
         # [2] setup project folders
-        print(green('\nCreating folders'))
+        utils.records.step('Creating folders')
         folders_to_create = [
             env.project_path,
             env.cache_path,
@@ -160,7 +182,7 @@ class Setup(ProvisioningTask):
             sudo('mkdir %s' % folder)
 
         # [3] copy files
-        print(green('\nCopying script files'))
+        utils.records.step('Copying script files')
         files_to_copy =  os.listdir(local_scripts_path)
 
         for file_name in files_to_copy:
@@ -184,6 +206,15 @@ class Setup(ProvisioningTask):
             {'template': 'provision_db_sql.txt', 'file': 'scripts/provision_db.sql', },
         ]
 
+        # blue/green: a wsgi file per backend, each running the instance its <color>_instance links to
+        if blue_green:
+            for color in utils.bluegreen.COLORS:
+                files_to_create.append({
+                    'template': 'django_wsgi.txt',
+                    'file': '%s.wsgi' % color,
+                    'context': {'current_instance_path': os.path.join(env.project_path, '%s_instance' % color)},
+                })
+
         context = {
             'project_name': env.project_name,
             'current_instance_path': env.current_instance_path,
@@ -194,20 +225,20 @@ class Setup(ProvisioningTask):
         }
 
         # [4] create files from templates (using fabric env and user input)
-        print(green('\nCreating project files'))
+        utils.records.step('Creating project files')
         for file_to_create in files_to_create:
             upload_template(
                 filename = os.path.join(local_templates_path, file_to_create['template']),
                 destination = os.path.join(env.project_path, file_to_create['file']),
-                context = context,
+                context = dict(context, **file_to_create.get('context', {})),
                 use_sudo = True
             )
 
         # [5] create new database + user with all schema privileges (uses database root user)
-        print(green('\nCreating database `%s` with privileged db-user `%s`' % (
+        utils.records.step('Creating database `%s` with privileged db-user `%s`' % (
             database_name,
             project_user
-        )))
+        ))
 
         mysql_password = prompt(yellow('Password for mysql root user: '))
         mysql_command = 'mysql --batch --user=root --password=%s' % mysql_password
@@ -234,7 +265,7 @@ class Setup(ProvisioningTask):
                 sudo('htpasswd -bc .htpasswd %s %s' % (env.project_name, htpasswd))
 
         # [7] create webserver conf files
-        print(green('\nCreating vhost conf files'))
+        utils.records.step('Creating vhost conf files')
         try:
             # grep vhosts => reverse list => awk top port #
             output = run('%s | %s | %s' % (
@@ -243,10 +274,19 @@ class Setup(ProvisioningTask):
                 'awk \'{if (NR==1) { print substr($2,3) }}\''
             ))
             new_port_nr = int(output) + 1
-            print('Port %s will be used for this project' % magenta(new_port_nr))
         except:
             abort(red('Aborted. No available port # for vhost found.'))
 
+        # blue/green takes two ports, see utils.bluegreen
+        if blue_green:
+            ports = {'blue': new_port_nr, 'green': new_port_nr + 1}
+            print('Ports %s (blue) and %s (green) will be used for this project' % (
+                magenta(ports['blue']),
+                magenta(ports['green'])
+            ))
+        else:
+            print('Port %s will be used for this project' % magenta(new_port_nr))
+
         # check if htpasswd is used (some nginx vhost lines will be commented if it isn't)
         if not exists(htpasswd_path, use_sudo=True):
             use_htpasswd = '#'
@@ -265,15 +305,47 @@ class Setup(ProvisioningTask):
             'admin_email': env.admin_email,
             'project_user': project_user,
             'use_htpasswd': use_htpasswd,
+            'process_group': project_user,
+            'wsgi_file': 'django.wsgi',
+            'upstream': 'server 127.0.0.1:%s;' % new_port_nr,
         }
 
         # create the conf files from template and transfer them to remote server
-        upload_template(
-            filename = os.path.join(local_templates_path, 'apache_vhost.txt'),
-            destination = os.path.join(apache_conf_path, 'vhosts-%s.conf' % project_user),
-            context = context,
-            use_sudo = True
-        )
+        if blue_green:
+            # an apache vhost per backend, nginx proxies to the one upstream.conf links to
+            for color in utils.bluegreen.COLORS:
+                upload_template(
+                    filename = os.path.join(local_templates_path, 'apache_vhost.txt'),
+                    destination = os.path.join(apache_conf_path, 'vhosts-%s-%s.conf' % (project_user, color)),
+                    context = dict(context, **{
+                        'port_number': ports[color],
+                        'process_group': '%s-%s' % (project_user, color),
+                        'wsgi_file': '%s.wsgi' % color,
+                    }),
+                    use_sudo = True
+                )
+            utils.bluegreen.create_upstreams(env.project_path, ports)
+            context['upstream'] = 'include %s;' % os.path.join(utils.bluegreen.get_nginx_path(env.project_path), 'upstream.conf')
+
+            # project user reloads nginx when switching backends
+            # a broken sudoers file locks out sudo, so it is checked by visudo before it is moved into place
+            # (sudo ignores files with a dot in sudoers.d, like the temporary one)
+            if not hasattr(env, 'nginx_reload_command'):
+                sudoers_file = os.path.join(getattr(env, 'sudoers_path', os.path.join('/', 'etc', 'sudoers.d')), project_user)
+                output = sudo("echo '%s ALL=(root) NOPASSWD: %s reload' > %s.tmp && chmod 440 %s.tmp && visudo -cf %s.tmp && mv %s.tmp %s || { rm -f %s.tmp; false; }" % (
+                    project_user,
+                    os.path.join(init_path, 'nginx'),
+                    sudoers_file, sudoers_file, sudoers_file, sudoers_file, sudoers_file, sudoers_file
+                ))
+                if output.failed:
+                    abort(red('Could not install sudoers rule %s: %s' % (sudoers_file, output)))
+        else:
+            upload_template(
+                filename = os.path.join(local_templates_path, 'apache_vhost.txt'),
+                destination = os.path.join(apache_conf_path, 'vhosts-%s.conf' % project_user),
+                context = context,
+                use_sudo = True
+            )
         upload_template(
             filename = os.path.join(local_templates_path, 'nginx_vhost.txt'),
             destination = os.path.join(nginx_conf_path, 'vhosts-%s.conf' % project_user),
@@ -282,20 +354,20 @@ class Setup(ProvisioningTask):
         )
 
         # chown project for project user
-        print(green('\nChanging ownership of %s to `%s`' % (env.project_path, project_user)))
+        utils.records.step('Changing ownership of %s to `%s`' % (env.project_path, project_user))
         sudo('chown -R %s:%s %s' % (project_user, project_user, env.project_path))
 
         # [8] prompt for webserver restart 
-        print(green('\nTesting webserver configuration'))
+        utils.records.step('Testing webserver configuration')
         with settings(show('stdout')):
-            sudo('/etc/init.d/httpd configtest')
-            sudo('/etc/init.d/nginx configtest')
+            sudo('%s configtest' % os.path.join(init_path, 'httpd'))
+            sudo('%s configtest' % os.path.join(init_path, 'nginx'))
             print('')
 
         if confirm(yellow('\nOK to restart webserver?')):
             with settings(show('stdout')):
-                sudo('/etc/init.d/httpd restart')
-                sudo('/etc/init.d/nginx restart')
+                sudo('%s restart' % os.path.join(init_path, 'httpd'))
+                sudo('%s restart' % os.path.join(init_path, 'nginx'))
                 print('')
         else:
             print(magenta('Website will be available when webservers are restarted.'))
@@ -330,11 +402,11 @@ class Keys(ProvisioningTask):
     def __call__(self):
 
         project_user = env.project_name_prefix + env.project_name
-        local_ssh_path = os.path.join('/', 'home', env.local_user, '.ssh')
+        local_ssh_path = getattr(env, 'local_ssh_path', os.path.join('/', 'home', env.local_user, '.ssh'))
         local_ssh_files = os.listdir(local_ssh_path)
         local_key_files = [f for f in local_ssh_files if f[-4:] == '.pub']
         selected_key_nr = 0
-        remote_auth_keys = os.path.join('/', 'home', project_user, '.ssh', 'authorized_keys')
+        remote_auth_keys = os.path.join(getattr(env, 'home_root', '/home'), project_user, '.ssh', 'authorized_keys')
 
         if not local_key_files:
             abort(red('No public keys found in %s' % local_ssh_path))
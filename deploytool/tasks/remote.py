@@ -7,6 +7,7 @@ from fabric.operations import require
 from fabric.operations import open_shell
 from fabric.tasks import Task
 import os
+import time
 
 import deploytool.utils as utils
 
@@ -59,12 +60,16 @@ class RemoteHost(Task):
             'user': project_name,
         })
 
+        # open connections to all hosts up front, they are reused by all following tasks
+        utils.network.preconnect(env.hosts)
+
 
 class RemoteTask(Task):
     """
     Base class for remote tasks
         - updates fabric env for instance
         - handles logging
+        - traces remote operations without running them for `fab live <task>:trace=1`
     """
 
     requirements = [
@@ -72,6 +77,9 @@ class RemoteTask(Task):
         'project_name',
     ]
 
+    # append timed steps of every run to ./log/fabric.jsonl
+    record = True
+
     def __call__(self, *args, **kwargs):
         """ Task implementation - called from self.run() """
 
@@ -96,6 +104,12 @@ class RemoteTask(Task):
 
         append(os.path.join(env.log_path, 'fabric.log'), message)
 
+    def update_sizes(self, virtualenv_path=None):
+        """ Refreshes size index for the instance written or removed by this task, see utils.instance.update_size_index() """
+
+        utils.records.step('Updating size index.')
+        utils.instance.update_size_index(virtualenv_path or env.virtualenv_path, env.scripts_path, env.project_path, [env.instance_stamp])
+
     def run(self, *args, **kwargs):
         """ Hide output, update fabric env, run task """
 
@@ -130,7 +144,24 @@ class RemoteTask(Task):
             })
 
             # finally, run the task implementation!
-            self(*args, **kwargs)
+            start = time.time()
+            success = False
+            if self.record:
+                utils.records.start(self.name)
+
+            # trace=1 records remote operations instead of running them, see utils.trace
+            trace = kwargs.pop('trace', None)
+            if trace:
+                utils.trace.start()
+
+            try:
+                self(*args, **kwargs)
+                success = True
+            finally:
+                utils.network.record_task(self.name, time.time() - start)
+                utils.records.finish(success)
+                if trace:
+                    utils.trace.stop()
 
 
 class Deployment(RemoteTask):
@@ -147,6 +178,18 @@ class Deployment(RemoteTask):
 
         # deployment for a specific git commit ID
         $ fab staging.deploy:commit=1ec9d293ce54647df7f15ee7c0295b8eb2a5cbef
+
+        # deployment to all hosts at once, building on 3 hosts at a time
+        $ fab staging.deploy:parallel=3
+
+        # always backup/sync/migrate database, even without schema changes
+        $ fab staging.deploy:migrate=always
+
+        # compare latency with previous deploy after restart, roll back on regressions (see env.smoke_test)
+        $ fab staging.deploy:smoke=1
+
+        # list remote operations (round trips, payload) without changing anything
+        $ fab staging.deploy:trace=1
     """
 
     name = 'deploy'
@@ -160,6 +203,10 @@ class Deployment(RemoteTask):
             branch  => deploy by HEAD for branch
         """
 
+        # skip hosts that were already deployed in parallel
+        if env.host_string in getattr(self, 'deployed_hosts', []):
+            return
+
         with settings(hide('warnings', 'running', 'stdout', 'stderr'), warn_only=True):
 
             # deploy by local commit
@@ -174,7 +221,7 @@ class Deployment(RemoteTask):
             else:
                 self.stamp = utils.source.get_head()
                 _args = (utils.source.get_branch_name(), self.stamp)
-                question = '\nDeploy branch %s at commit %s?' % _args
+                question = '\n%s branch %s at commit %s?' % ((self.name.capitalize(),) + _args)
 
                 if not confirm(yellow(question)):
                     abort(red('Aborted deployment. Run `fab -d %s` for options.' % self.name))
@@ -183,155 +230,558 @@ class Deployment(RemoteTask):
 
     def __call__(self, *args, **kwargs):
 
-        # check if deploy is possible
-        if self.stamp == utils.instance.get_instance_stamp(env.current_instance_path):
+        pause_at = self.parse_options(kwargs)
+
+        # deploy all hosts at once, see deploy_parallel()
+        pool_size = int(kwargs.get('parallel', getattr(env, 'deploy_parallel', 0)))
+        if pool_size > 0 and len(env.all_hosts) > 1 and not utils.trace.active:
+            if pause_at:
+                abort(red('Deploy aborted because pausing is not possible when deploying in parallel.'))
+            # a regression would roll back the shared database once per host
+            if self.smoke:
+                abort(red('Deploy aborted because smoke testing is not possible when deploying in parallel, use smoke=0 or parallel=0.'))
+            return self.deploy_parallel(pool_size)
+
+        self.check()
+
+        # start deploy
+        try:
+            self.build()
+        except:
+            self.log(success=False)
+
+            print(yellow('\nRemoving this instance from filesystem.'))
+            self.discard()
+
+            abort(red('Deploy failed and was rolled back.'))
+
+        self.update_database(pause_at)
+
+        if ('before_restart' in pause_at):
+            utils.records.step('Opening remote shell.')
+            open_shell()
+
+        try:
+            self.activate()
+        except Exception, e:
+            print(red('\n%s' % e))
+            self.revert()
+
+        self.smoke_test()
+
+        if ('after_restart' in pause_at):
+            utils.records.step('Opening remote shell.')
+            open_shell()
+
+        self.log(success=True)
+        self.deduplicate()
+        self.update_sizes()
+        self.prune_instances()
+
+    def parse_options(self, kwargs):
+        """
+        Reads pause, migrate and smoke options from CLI kwargs, returns steps to pause at
+
+            pause   => comma separated steps, e.g. `fab staging deploy:pause=before_migrate`
+            migrate => database is only updated when schema changes are found, unless migrate=always
+            smoke   => smoke test after restart, default env.smoke_test
+        """
+
+        self.migrate = kwargs.get('migrate', 'auto')
+        self.smoke = bool(int(kwargs.get('smoke', getattr(env, 'smoke_test', False))))
+
+        return kwargs['pause'].split(',') if ('pause' in kwargs) else []
+
+    def deploy_parallel(self, pool_size):
+        """
+        Deploy to all hosts at once
+            - build phase runs on all hosts concurrently (at most pool_size at a time)
+            - waits for all builds, any failure removes this instance from every host
+            - database is updated once (on first host)
+            - cutover runs on all hosts together
+        """
+
+        hosts = env.all_hosts
+
+        # workers return their own timed steps, see utils.records.merge()
+        def build(host):
+            utils.records.fork()
+            self.check()
+            try:
+                self.build()
+            except:
+                print(yellow('\nRemoving this instance from filesystem.'))
+                self.discard()
+                raise
+            return utils.records.collect()
+
+        def discard(host):
+            self.discard()
+
+        def activate(host):
+            utils.records.fork()
+            self.activate()
+            self.log(success=True)
+            self.deduplicate()
+            self.update_sizes()
+            self.prune_instances()
+            return utils.records.collect()
+
+        utils.records.step('Building instance on %d hosts, %d at a time.' % (len(hosts), pool_size))
+        results = utils.parallel.run_on_hosts(hosts, build, pool_size)
+        failed_hosts = [h for h in hosts if not results[h][0]]
+        built_hosts = [h for h in hosts if results[h][0]]
+        for host in built_hosts:
+            utils.records.merge(results[host][1])
+
+        if failed_hosts:
+            self.log(success=False)
+
+            print(yellow('\nRemoving this instance from %s.' % str.join(', ', built_hosts)))
+            utils.parallel.run_on_hosts(built_hosts, discard, pool_size)
+
+            abort(red('Deploy failed on %s and was rolled back on all hosts.' % str.join(', ', failed_hosts)))
+
+        # all hosts are ready, database is shared so it is updated once
+        with utils.parallel.on_host(hosts[0]):
+            try:
+                self.update_database([], discard=False)
+            except SystemExit:
+                print(yellow('\nRemoving this instance from all hosts.'))
+                utils.parallel.run_on_hosts(hosts, discard, pool_size)
+                raise
+
+        utils.records.step('Activating instance on all hosts.')
+        results = utils.parallel.run_on_hosts(hosts, activate, len(hosts))
+        failed_hosts = [h for h in hosts if not results[h][0]]
+        for host in hosts:
+            if results[host][0]:
+                utils.records.merge(results[host][1])
+
+        if failed_hosts:
+            abort(red('Activating instance failed on %s.' % str.join(', ', failed_hosts)))
+
+        # every host is done, skip the remaining per-host invocations by fabric
+        self.deployed_hosts = hosts
+
+    def check(self):
+        """ Abort if deploy is not possible on current host """
+
+        current_stamp = utils.instance.get_instance_stamp(env.current_instance_path)
+
+        if self.stamp == current_stamp:
             abort(red('Deploy aborted because %s is already the current instance.' % self.stamp))
         if self.stamp == utils.instance.get_instance_stamp(env.previous_instance_path):
             abort(red('Deploy aborted because %s is the previous instance. Use rollback task instead.' % self.stamp))
         if exists(env.instance_path):
+            if self.stamp in utils.instance.get_staged_instances(env.project_path):
+                abort(red('Deploy aborted because instance %s is staged. Use activate task instead.' % self.stamp))
             abort(red('Deploy aborted because instance %s has already been deployed.' % self.stamp))
 
-        """
-        parse optional 'pause' argument, can be given like this:
+    def build(self):
+        """ Build instance on current host: folders, source, virtualenv, requirements, static files """
 
-        fab staging deploy:pause=before_migrate
-        """
-        pause_at = kwargs['pause'].split(',') if ('pause' in kwargs) else []
+        current_stamp = utils.instance.get_instance_stamp(env.current_instance_path)
 
-        # start deploy
-        try:
-            print(green('\nCreating folders.'))
-            folders_to_create = [
-                env.instance_path,
-                env.backup_path,
-                env.source_path,
-                env.virtualenv_path,
-            ]
+        utils.records.step('Creating folders.')
+        folders_to_create = [
+            env.instance_path,
+            env.backup_path,
+            env.source_path,
+            env.virtualenv_path,
+        ]
+        with utils.commands.Batch() as batch:
             for folder in folders_to_create:
-                utils.commands.create_folder(folder)
-
-            print(green('\nDeploying source.'))
-            utils.source.transfer_source(upload_path=env.source_path, tree=self.stamp)
+                batch.create_folder(folder)
+
+        utils.records.step('Deploying source.')
+        base_path = None
+        if exists(env.current_instance_path):
+            # ship only what changed since the current instance
+            base_path = os.path.join(env.project_path, current_stamp, env.project_name)
+
+        utils.source.transfer_source(
+            upload_path = env.source_path,
+            tree = self.stamp,
+            base_path = base_path,
+            base_tree = current_stamp
+        )
 
-            print(green('\nCreating virtual environment.'))
+        # reuse virtual environment of current instance when requirements allow it
+        requirements_hash = utils.instance.get_requirements_hash(env.project_source_path)
+        current_instance_path = os.path.join(env.project_path, current_stamp)
+        current_hash = None
+        if exists(env.current_instance_path):
+            current_hash = utils.instance.read_requirements_hash(current_instance_path)
+
+        if current_hash:
+            utils.records.step('Cloning virtual environment of current instance.')
+            utils.instance.clone_virtualenv(
+                from_path = os.path.join(current_instance_path, 'env'),
+                to_path = env.virtualenv_path,
+                hardlink = bool(current_hash == requirements_hash)
+            )
+        else:
+            utils.records.step('Creating virtual environment.')
             utils.instance.create_virtualenv(env.virtualenv_path, env.user)
 
-            print(green('\nCopying .pth files.'))
-            put('%s/*.pth' % getattr(env, 'project_source_folder', '.'), '%s/lib/python2.6/site-packages' % env.virtualenv_path)
+        utils.records.step('Copying .pth files.')
+        put('%s/*.pth' % getattr(env, 'project_source_folder', '.'), '%s/lib/python2.6/site-packages' % env.virtualenv_path)
 
-            print(green('\nPip installing requirements.'))
-            utils.instance.pip_install_requirements(
+        if current_hash == requirements_hash:
+            utils.records.step('Requirements unchanged, skipping pip.')
+        else:
+            wheelhouse_path = None
+            if getattr(env, 'wheelhouse', False):
+                utils.records.step('Shipping wheelhouse.')
+                wheelhouse_path = os.path.join(env.instance_path, 'wheelhouse')
+                utils.wheelhouse.transfer_wheelhouse(utils.wheelhouse.build_wheelhouse(self.stamp), wheelhouse_path)
+
+            utils.records.step('Pip installing requirements.')
+            synced = bool(current_hash) and utils.instance.pip_sync_requirements(
                 env.virtualenv_path,
+                os.path.join(current_instance_path, env.project_name, getattr(env, 'project_source_folder', '')),
                 env.project_source_path,
                 env.cache_path,
-                env.log_path
+                env.log_path,
+                wheelhouse_path
             )
-
-            print(green('\nCopying settings.py.'))
-            utils.commands.copy(
-                from_path = os.path.join(env.project_path, 'settings.py'),
-                to_path = os.path.join(env.project_source_path, 'settings.py')
+            if not synced:
+                utils.instance.pip_install_requirements(
+                    env.virtualenv_path,
+                    env.project_source_path,
+                    env.cache_path,
+                    env.log_path,
+                    wheelhouse_path
+                )
+
+            if wheelhouse_path:
+                utils.commands.delete(wheelhouse_path)
+
+        utils.instance.write_requirements_hash(env.instance_path, requirements_hash)
+
+        utils.records.step('Copying settings.py and linking media folder.')
+        with utils.commands.Batch() as batch:
+            # a tracked settings.py may be seeded as hardlink into the current instance, don't write through it
+            batch.delete(os.path.join(env.project_source_path, 'settings.py'))
+            batch.copy(
+                os.path.join(env.project_path, 'settings.py'),
+                os.path.join(env.project_source_path, 'settings.py')
             )
-
-            print(green('\nLinking media folder.'))
-            utils.commands.create_symbolic_link(
-                real_path = os.path.join(env.project_path, 'media'),
-                symbolic_path = os.path.join(env.project_source_path, 'media')
+            batch.create_symbolic_link(
+                os.path.join(env.project_path, 'media'),
+                os.path.join(env.project_source_path, 'media')
             )
 
-            print(green('\nCollecting static files.'))
-            utils.commands.django_manage(
+        utils.records.step('Collecting static files.')
+        utils.commands.django_manage(
+            env.virtualenv_path,
+            env.project_source_path,
+            'collectstatic --link --noinput --verbosity=0 --traceback'
+        )
+
+        if getattr(env, 'static_store', False):
+            utils.records.step('Linking static files from shared store.')
+            utils.instance.store_static_files(
                 env.virtualenv_path,
-                env.project_source_path,
-                'collectstatic --link --noinput --verbosity=0 --traceback'
+                env.scripts_path,
+                env.project_path,
+                os.path.join(env.project_source_path, getattr(env, 'static_folder', 'static')),
+                env.instance_path,
+                base_path and current_instance_path or None
             )
-        except:
-            self.log(success=False)
 
-            print(yellow('\nRemoving this instance from filesystem.'))
-            utils.commands.delete(env.instance_path)
+    def discard(self):
+        """ Remove this instance from current host """
 
-            abort(red('Deploy failed and was rolled back.'))
+        utils.commands.delete(env.instance_path)
+
+    def update_database(self, pause_at, discard=True):
+        """ Backup, sync and migrate database, restore it when anything fails """
+
+        self.database_skipped = not self.needs_database_update()
+        if self.database_skipped:
+            print(green('\nNo schema changes found, skipping database update.'))
+            return
+
+        backup_file = utils.instance.get_backup_file(env.backup_path, 'db_backup_start')
+        self.backup_file = backup_file
 
-        # update database
         try:
-            print(green('\nBacking up database at start.'))
-            utils.instance.backup_database(
-                env.virtualenv_path,
-                env.scripts_path,
-                os.path.join(env.backup_path, 'db_backup_start.sql')
-            )
+            utils.records.step('Backing up database at start.')
+            utils.instance.backup_database(env.virtualenv_path, env.scripts_path, backup_file)
 
             with settings(show('stdout')):
                 if ('before_syncdb' in pause_at):
-                    print(green('\nOpening remote shell.'))
+                    utils.records.step('Opening remote shell.')
                     open_shell()
 
-                print(green('\nSyncing database.'))
+                utils.records.step('Syncing database.')
                 utils.commands.django_manage(env.virtualenv_path, env.project_source_path, 'syncdb')
                 print('')
 
                 if ('before_migrate' in pause_at):
-                    print(green('\nOpening remote shell.'))
+                    utils.records.step('Opening remote shell.')
                     open_shell()
 
-                print(green('\nMigrating database.'))
+                utils.records.step('Migrating database.')
                 utils.commands.django_manage(env.virtualenv_path, env.project_source_path, 'migrate')
                 print('')
 
-            print(green('\nBacking up database at end.'))
+            utils.records.step('Backing up database at end.')
             utils.instance.backup_database(
                 env.virtualenv_path,
                 env.scripts_path,
-                os.path.join(env.backup_path, 'db_backup_end.sql')
+                utils.instance.get_backup_file(env.backup_path, 'db_backup_end')
             )
         except:
-            self.log(success=False)
+            self.revert(discard)
+
+    def revert(self, discard=True):
+        """ Restore database from backup at start of this deploy (if it was updated), remove this instance and abort """
 
+        self.log(success=False)
+
+        if getattr(self, 'backup_file', None):
             print(yellow('\nRestoring database.'))
-            utils.instance.restore_database(
-                env.virtualenv_path,
-                env.scripts_path,
-                os.path.join(env.backup_path, 'db_backup_start.sql')
-            )
+            utils.instance.restore_database(env.virtualenv_path, env.scripts_path, self.backup_file)
 
-            print(green('\nRemoving this instance from filesystem.'))
-            utils.commands.delete(env.instance_path)
+        if discard:
+            utils.records.step('Removing this instance from filesystem.')
+            self.discard()
 
-            abort(red('Deploy failed and was rolled back.'))
+        abort(red('Deploy failed and was rolled back.'))
 
-        if ('before_restart' in pause_at):
-            print(green('\nOpening remote shell.'))
-            open_shell()
+    def needs_database_update(self):
+        """ Checks for schema changes since current instance, or pending migrations """
+
+        if getattr(self, 'migrate', 'auto') == 'always' or not exists(env.current_instance_path):
+            return True
+
+        current_stamp = utils.instance.get_instance_stamp(env.current_instance_path)
+        if not utils.source.has_commit(current_stamp):
+            return True
+        if utils.source.has_schema_changes(current_stamp, self.stamp):
+            return True
+
+        return utils.instance.has_pending_migrations(env.virtualenv_path, env.project_source_path)
 
-        print(green('\nUpdating instance symlinks.'))
-        utils.instance.set_current_instance(env.project_path, env.instance_path)
+    def activate(self):
+        """ Make this instance the current instance and restart website, raises Exception if it can't serve yet """
 
-        print(green('\nRestarting website.'))
+        if getattr(self, 'database_skipped', False):
+            utils.instance.mark_database_skipped(env.backup_path)
+
+        if getattr(env, 'blue_green', False):
+            return self.activate_color()
+
+        utils.records.step('Updating instance symlinks.')
+        self.link_targets = utils.instance.set_current_instance(env.project_path, env.instance_path)
+
+        utils.records.step('Restarting website.')
         utils.commands.touch_wsgi(env.project_path)
 
-        if ('after_restart' in pause_at):
-            print(green('\nOpening remote shell.'))
-            open_shell()
+    def activate_color(self):
+        """ Blue/green: start this instance on the idle backend, warm it up, then switch nginx to it """
 
-        self.log(success=True)
-        self.prune_instances()
+        state = utils.bluegreen.get_state(env.project_path)
+        color = state['idle']
+
+        utils.records.step('Starting instance on idle %s backend (port %d).' % (color, state['ports'][color]))
+        utils.bluegreen.start_color(env.project_path, color, env.instance_path)
+
+        self.backend_port = state['ports'][color]
+
+        utils.records.step('Warming up %s backend.' % color)
+        if not utils.bluegreen.warm_up(env.virtualenv_path, env.scripts_path, state['ports'][color]):
+            raise Exception('Warm-up of %s backend failed, website is still served by %s backend.' % (color, state['active']))
+
+        # previous instance keeps running on the other backend, for instant rollback
+        utils.records.step('Switching nginx to %s backend.' % color)
+        utils.bluegreen.switch_color(env.project_path, color)
+
+        utils.records.step('Updating instance symlinks.')
+        self.link_targets = utils.instance.set_current_instance(env.project_path, env.instance_path)
+
+    def smoke_test(self):
+        """ Compares latency and errors of the new instance with the previous deploy, rolls back on regressions """
+
+        if not getattr(self, 'smoke', False):
+            return
+
+        utils.records.step('Smoke testing new instance.')
+        port = getattr(self, 'backend_port', None) or int(getattr(env, 'smoke_test_port', 80))
+        result = utils.smoke.run_smoke_test(env.virtualenv_path, env.scripts_path, port)
+        if not result:
+            print(yellow('Smoke test could not run, see scripts/smoke_test.py.'))
+            return
+
+        baseline = utils.smoke.get_baseline(env.log_path)
+        result['regressions'] = utils.smoke.compare(result, baseline)
+        utils.records.note('smoke_test', result)
+        print(utils.smoke.describe(result, baseline))
+
+        if result['regressions']:
+            self.log(success=False)
+            print(red('\nRegressions: %s' % str.join(', ', result['regressions'])))
+
+            rollback = Rollback()
+            rollback.stamp = self.stamp
+            rollback()
+
+            abort(red('Deploy was rolled back because the smoke test found regressions.'))
+
+    def deduplicate(self):
+        """ Hardlinks files of this instance that are identical to files of retained instances (env.dedup) """
+
+        if getattr(env, 'dedup', False):
+            utils.records.step('Deduplicating instance files.')
+            utils.instance.deduplicate_instance(env.virtualenv_path, env.scripts_path, env.project_path, env.instance_path)
 
     def prune_instances(self):
-        """ Find old instances and remove them to free up space """
+        """
+        Removes instances outside the retention policy to free up space
+            - keeps current, previous and staged instances
+            - env.keep_instances (default 5 newest), env.keep_days, env.instance_budget (bytes)
+            - deleting happens in the background, see utils.instance.remove_instances()
+        """
+
+        budget = getattr(env, 'instance_budget', None)
+        max_age = getattr(env, 'keep_days', None)
+
+        # links were just swapped by activate(), no need to read them again
+        inventory = utils.instance.get_inventory(
+            env.project_path,
+            sizes = bool(budget),
+            link_targets = getattr(self, 'link_targets', None)
+        )
+        old_instances = utils.instance.select_obsolete_instances(
+            inventory,
+            keep = int(getattr(env, 'keep_instances', 5)),
+            max_age = max_age and float(max_age) * 86400,
+            budget = budget and int(budget)
+        )
+        if not old_instances:
+            return
+
+        # stores can only be cleaned after the instances are gone, and then the size index
+        cleanup_commands = []
+        if getattr(env, 'static_store', False):
+            cleanup_commands.append(utils.instance.get_static_gc_command(env.virtualenv_path, env.scripts_path, env.project_path))
+        if getattr(env, 'dedup', False):
+            cleanup_commands.append(utils.instance.get_dedup_gc_command(env.virtualenv_path, env.scripts_path, env.project_path))
+        cleanup_commands.append(utils.instance.get_size_index_command(env.virtualenv_path, env.scripts_path, env.project_path))
+
+        utils.records.step('Removing old instances in the background.')
+        utils.instance.remove_instances(env.project_path, env.log_path, old_instances, cleanup_commands)
 
-        old_instances = utils.instance.get_obsolete_instances(env.project_path)
+        print(green('\nThese old instances are being removed from remote filesystem:'))
+        print(old_instances)
+
+
+class Stage(Deployment):
+    """
+    REMO - Build new instance ahead of time, without touching database or current instance
+
+        Usage:
+
+        # build instance for current git HEAD (branch and commit work like deploy)
+        $ fab live.stage:branch=my-branch
+
+        # later, in the maintenance window
+        $ fab live.activate
+    """
 
-        for instance in old_instances:
-            is_current = bool(utils.instance.get_instance_stamp(env.current_instance_path) == instance)
-            is_previous = bool(utils.instance.get_instance_stamp(env.previous_instance_path) == instance)
+    name = 'stage'
 
-            if not (is_current or is_previous):
-                utils.commands.delete(os.path.join(env.project_path, instance))
+    def __call__(self, *args, **kwargs):
+
+        self.check()
+
+        try:
+            self.build()
+        except:
+            self.log(success=False)
+
+            print(yellow('\nRemoving this instance from filesystem.'))
+            self.discard()
+
+            abort(red('Staging failed and was rolled back.'))
+
+        utils.records.step('Marking instance as staged.')
+        utils.instance.mark_instance_staged(env.instance_path)
+        self.log(success=True)
+        self.deduplicate()
+        self.update_sizes()
+
+        print(green('\nStaged instance %s, run the activate task to make it current.' % self.stamp))
+
+
+class Activate(Deployment):
+    """
+    REMO - Activate staged instance: backup/migrate database, swap symlinks, restart
 
-        if len(old_instances) > 0:
-            print(green('\nThese old instances were removed from remote filesystem:'))
-            print(old_instances)
+        Usage:
+
+        # activate most recently staged instance
+        $ fab live.activate
+
+        # activate a specific staged instance
+        $ fab live.activate:commit=1ec9d293ce54647df7f15ee7c0295b8eb2a5cbef
+
+        # pause, migrate and smoke options work like deploy
+        $ fab live.activate:migrate=always,pause=before_migrate,smoke=1
+    """
+
+    name = 'activate'
+
+    def run(self, *args, **kwargs):
+        """ Load instance from CLI kwargs, or most recently staged instance """
+
+        if kwargs.has_key('commit'):
+            self.stamp = kwargs['commit']
+
+        elif hasattr(env, 'project_path'):
+            with settings(hide('warnings', 'running', 'stdout', 'stderr'), warn_only=True):
+                staged_instances = utils.instance.get_staged_instances(env.project_path)
+
+            if not staged_instances:
+                abort(red('Activation aborted because no staged instance was found. Run stage task first.'))
+            self.stamp = staged_instances[0]
+
+        super(Deployment, self).run(*args, **kwargs)
+
+    def __call__(self, *args, **kwargs):
+
+        pause_at = self.parse_options(kwargs)
+
+        if not exists(os.path.join(env.instance_path, utils.instance.STAGED_FILE)):
+            abort(red('Activation aborted because %s is not a staged instance.' % self.stamp))
+
+        # a failed database update leaves the staged instance in place for another try
+        self.update_database(pause_at, discard=False)
+
+        if ('before_restart' in pause_at):
+            utils.records.step('Opening remote shell.')
+            open_shell()
+
+        # a failed warm-up leaves the staged instance in place for another try
+        try:
+            self.activate()
+        except Exception, e:
+            print(red('\n%s' % e))
+            self.revert(discard=False)
+
+        utils.commands.delete(os.path.join(env.instance_path, utils.instance.STAGED_FILE))
+        self.smoke_test()
+
+        if ('after_restart' in pause_at):
+            utils.records.step('Opening remote shell.')
+            open_shell()
+
+        self.log(success=True)
+        self.update_sizes()
+        self.prune_instances()
 
 
 class Rollback(RemoteTask):
@@ -344,79 +794,192 @@ class Rollback(RemoteTask):
         # check if rollback is possible
         if not exists(env.previous_instance_path):
             abort(red('No rollback possible. No previous instance found to rollback to.'))
-        if not exists(os.path.join(env.backup_path, 'db_backup_start.sql')):
+        database_skipped = utils.instance.is_database_skipped(env.backup_path)
+        backup_file = utils.instance.find_backup_file(env.backup_path, 'db_backup_start')
+        if not (backup_file or database_skipped):
             abort(red('Could not find backupfile to restore database with.'))
 
         # start rollback
         try:
-            print(green('\nRestoring database to start of this instance.'))
-            utils.instance.restore_database(
-                env.virtualenv_path,
-                env.scripts_path,
-                os.path.join(env.backup_path, 'db_backup_start.sql')
-            )
+            if database_skipped:
+                utils.records.step('Database was not changed by this instance, no restore needed.')
+            else:
+                utils.records.step('Restoring database to start of this instance.')
+                utils.instance.restore_database(env.virtualenv_path, env.scripts_path, backup_file)
 
-            print(green('\nRemoving this instance and set previous to current.'))
-            utils.instance.rollback(env.project_path)
+            utils.records.step('Removing this instance and set previous to current.')
+            link_targets = utils.instance.rollback(env.project_path)
+            if not link_targets:
+                raise Exception('previous instance disappeared')
 
-            print(green('\nRestarting website.'))
-            utils.commands.touch_wsgi(env.project_path)
+            if getattr(env, 'blue_green', False):
+                self.switch_back(link_targets[1])
+            else:
+                utils.records.step('Restarting website.')
+                utils.commands.touch_wsgi(env.project_path)
 
-            print(green('\nRemoving this instance from filesystem.'))
+            utils.records.step('Removing this instance from filesystem.')
             utils.commands.delete(env.instance_path)
 
             self.log(success=True)
 
+            # virtualenv of this instance is gone, the index drops its folder
+            self.update_sizes(os.path.join(env.current_instance_path, 'env'))
+
         except Exception, e:
             self.log(success=False)
             abort(red('Rollback failed: %s ' % e.message))
 
+    def switch_back(self, instance_path):
+        """ Blue/green: switch nginx to the idle backend, which still runs the previous instance after a deploy """
+
+        state = utils.bluegreen.get_state(env.project_path)
+        color = state['idle']
+
+        if state['instances'][color] != instance_path:
+            utils.records.step('Starting previous instance on %s backend.' % color)
+            utils.bluegreen.start_color(env.project_path, color, instance_path)
+            utils.bluegreen.warm_up(os.path.join(instance_path, 'env'), env.scripts_path, state['ports'][color])
+
+        utils.records.step('Switching nginx to %s backend.' % color)
+        utils.bluegreen.switch_color(env.project_path, color)
+
 
 class Status(RemoteTask):
-    """ REMO - Show status information for remote host """
+    """
+    REMO - Show status information for all remote hosts
+
+        - every host is probed concurrently with one round trip, over the connections opened by the host task (see utils.status)
+        - hosts that run another instance than most hosts are highlighted
+    """
 
     name = 'status'
+    record = False
 
     def __call__(self, *args, **kwargs):
 
-        print(green('\nCurrent size of entire project:'))
-        print(utils.commands.get_folder_size(env.project_path))
+        # all hosts were shown by the first call
+        if env.host_string in getattr(self, 'probed_hosts', []):
+            return
 
-        print(green('\nCurrent instance:'))
-        current_instance = utils.commands.read_link(env.current_instance_path)
-        if current_instance != env.current_instance_path:
-            print(current_instance)
-        else:
-            print(red('[none]'))
+        hosts = env.all_hosts or [env.host_string]
+        results = {}
+        errors = {}
 
-        print(green('\nPrevious instance:'))
-        previous_instance = utils.commands.read_link(env.previous_instance_path)
-        if previous_instance != env.previous_instance_path:
-            print(previous_instance)
+        if len(hosts) > 1 and not utils.trace.active:
+            def probe(host):
+                return utils.status.probe(env.project_path, host_string=host)
+
+            for host, (succeeded, result) in utils.parallel.run_in_threads(hosts, probe).items():
+                if succeeded:
+                    results[host] = result
+                else:
+                    errors[host] = result
+        else:
+            hosts = [env.host_string]
+            results[env.host_string] = utils.status.probe(env.project_path)
+
+        for host in hosts:
+            if host in results and not results[host]:
+                errors[host] = '[none]'
+                del results[host]
+
+        self.probed_hosts = hosts
+
+        print(green('\nStatus:'))
+        print(str.join('\n', utils.status.format_table(hosts, results, errors)))
+
+        print(green('\nRecent runs:'))
+        lines = []
+        for result in results.values():
+            lines.extend(result['records'])
+        records = utils.records.parse(str.join('\n', lines))
+        if records:
+            records.sort(key=lambda r: r['started'])
+            print(str.join('\n', utils.records.summarize(records)))
         else:
             print(red('[none]'))
 
-        print(green('\nFabric log:'))
-        if exists(os.path.join(env.log_path, 'fabric.log')):
-            print(utils.commands.tail_file(os.path.join(env.log_path, 'fabric.log')))
-        else:
-            print(red('[empty]'))
+
+class Sizes(RemoteTask):
+    """
+    REMO - Refresh and show disk usage per folder of the project
+
+        Usage:
+
+        # refresh size index, only rescanning folders that changed since the last run
+        $ fab live.sizes
+
+        # rescan every folder, e.g. after files were changed in place
+        $ fab live.sizes:rebuild=1
+    """
+
+    name = 'sizes'
+    record = False
+
+    def __call__(self, *args, **kwargs):
+
+        rebuild = bool(kwargs.get('rebuild'))
+
+        utils.records.step(rebuild and 'Rebuilding size index.' or 'Refreshing size index.')
+        areas = utils.instance.update_size_index(env.virtualenv_path, env.scripts_path, env.project_path, rebuild=rebuild)
+        if not areas and not utils.trace.active:
+            abort(red('Could not update size index, run setup to install scripts/size_index.py.'))
+
+        print(green('\nDisk usage per folder:'))
+        print('    %-42s %10s %10s %10s' % ('folder', 'size', 'files', 'rescanned'))
+        for name in sorted(areas, key=lambda a: -areas[a]['size']):
+            print('    %-42s %10s %10d %10s' % (
+                name,
+                utils.commands.format_size(areas[name]['size']),
+                areas[name]['files'],
+                '%d/%d' % (areas[name]['rescanned'], areas[name]['folders'])
+            ))
+        print('    %-42s %10s' % ('total', utils.commands.format_size(sum([a['size'] for a in areas.values()]))))
 
 
 class Media(RemoteTask):
-    """ REMO - Download media files (as archive) """
+    """
+    REMO - Download media files (as archive)
+
+        Usage:
+
+        # download complete media folder as tarball
+        $ fab live.media
+
+        # download only new and changed files into ./media (interrupted syncs resume)
+        $ fab live.media:sync=1
+
+        # sync into another folder, comparing files by checksum instead of size and mtime
+        $ fab live.media:sync=1,path=/tmp/media,hash=1
+    """
 
     name = 'media'
 
     def __call__(self, *args, **kwargs):
 
-        file_name = 'project_media.tar'
         cwd = os.getcwd()
 
-        print(green('\nCompressing remote media folder.'))
-        utils.commands.create_tarball(env.project_path, 'media', file_name)
+        if kwargs.get('sync'):
+            local_path = os.path.abspath(kwargs.get('path', os.path.join(cwd, 'media')))
+
+            utils.records.step('Syncing remote media folder.')
+            utils.media.sync_media(env.media_path, local_path, bool(kwargs.get('hash')))
+
+            print(green('\nSynced media to:'))
+            print(local_path)
+            return
+
+        file_name = 'project_media.tar'
+
+        # an interrupted download keeps the remote tarball, continue with it
+        if utils.commands.find_partial_download(cwd, file_name) and exists(os.path.join(env.project_path, file_name)):
+            utils.records.step('Resuming download of existing tarball.')
+        else:
+            utils.records.step('Compressing remote media folder.')
+            utils.commands.create_tarball(env.project_path, 'media', file_name)
 
-        print(green('\nDownloading tarball.'))
+        utils.records.step('Downloading tarball.')
         utils.commands.download_file(
             remote_path = os.path.join(env.project_path, file_name),
             local_path = os.path.join(cwd, file_name)
@@ -427,28 +990,50 @@ class Media(RemoteTask):
 
 
 class Database(RemoteTask):
-    """ REMO - Download database (as sqldump) """
+    """
+    REMO - Download database (as compressed sqldump)
+
+        Usage:
+
+        # create and download new backup
+        $ fab live.database
+
+        # continue an interrupted download instead of creating a new backup
+        $ fab live.database:resume=1
+    """
 
     name = 'database'
 
     def __call__(self, *args, **kwargs):
 
-        timestamp = datetime.today().strftime('%y%m%d%H%M')
-        file_name = '%s_%s.sql' % (env.database_name, timestamp)
         cwd = os.getcwd()
+        backup_file = None
 
-        print(green('\nCreating backup.'))
-        utils.instance.backup_database(
-            env.virtualenv_path,
-            env.scripts_path,
-            os.path.join(env.backup_path, file_name)
-        )
+        if kwargs.get('resume'):
+            backup_file = utils.commands.find_partial_download(cwd, '%s_' % env.database_name)
+            if not backup_file or not exists(backup_file):
+                abort(red('No interrupted download to resume.'))
+            utils.records.step('Resuming download of %s.' % backup_file)
+        else:
+            timestamp = datetime.today().strftime('%y%m%d%H%M')
+            # downloads are always a single file
+            backup_file = utils.instance.get_backup_file(env.backup_path, '%s_%s' % (env.database_name, timestamp), 'single')
 
-        print(green('\nDownloading and removing remote backup.'))
-        utils.commands.download_file(
-            remote_path = os.path.join(env.backup_path, file_name),
-            local_path = os.path.join(os.getcwd(), file_name)
-        )
+            utils.records.step('Creating backup.')
+            utils.instance.backup_database(env.virtualenv_path, env.scripts_path, backup_file)
+
+        file_name = os.path.basename(backup_file)
+
+        # an interrupted download keeps the backup in the instance folder
+        try:
+            utils.records.step('Downloading and removing remote backup.')
+            utils.commands.download_file(
+                remote_path = backup_file,
+                local_path = os.path.join(cwd, file_name)
+            )
+            utils.commands.delete('%s.meta' % backup_file)
+        finally:
+            self.update_sizes()
 
         print(green('\nSaved backup to:'))
         print(os.path.join(cwd, file_name))
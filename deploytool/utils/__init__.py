@@ -1,3 +1,13 @@
 import commands
 import instance
 import source
+import wheelhouse
+import parallel
+import network
+import media
+import records
+import trace
+import bluegreen
+import smoke
+import status
+import registry
@@ -0,0 +1,109 @@
+from fabric.api import *
+from fabric.colors import *
+from pipes import quote
+import os
+
+import commands
+import instance
+
+
+# with env.blue_green every project has two backends (see Setup), nginx proxies to one of them
+COLORS = ['blue', 'green']
+
+
+def get_nginx_path(project_path):
+    """ Folder with <color>.conf upstream files, upstream.conf links to the active one """
+
+    return os.path.join(project_path, 'nginx')
+
+
+def get_reload_command():
+    """ Returns command that reloads nginx gracefully, run by the project user """
+
+    init_path = getattr(env, 'init_path', os.path.join('/', 'etc', 'init.d'))
+
+    return getattr(env, 'nginx_reload_command', 'sudo -n %s reload' % os.path.join(init_path, 'nginx'))
+
+
+def create_upstreams(project_path, ports):
+    """ Creates upstream file for every color in ports (dict of color => port), blue is active (as sudo) """
+
+    nginx_path = get_nginx_path(project_path)
+
+    sudo('mkdir %s' % nginx_path)
+    for color in COLORS:
+        sudo("echo 'server 127.0.0.1:%d;' > %s/%s.conf" % (ports[color], nginx_path, color))
+    sudo('ln -s %s.conf %s/upstream.conf' % (COLORS[0], nginx_path))
+
+
+def get_state(project_path):
+    """
+    Returns dict of blue/green state in one round trip
+        - active => color nginx proxies to, idle => the other color
+        - ports => color => backend port
+        - instances => color => instance path the backend runs (None if never started)
+    """
+
+    nginx_path = get_nginx_path(project_path)
+
+    lines = ['echo "active=$(readlink %s/upstream.conf)"' % nginx_path]
+    for color in COLORS:
+        lines.append('echo "%s_port=$(grep -o ":[0-9]*" %s/%s.conf | tr -d :)"' % (color, nginx_path, color))
+        lines.append('echo "%s_instance=$(readlink %s/%s_instance)"' % (color, project_path, color))
+
+    output = run(str.join('\n', lines))
+    values = dict([l.strip().split('=', 1) for l in output.splitlines() if '=' in l])
+
+    active = values.get('active', '').replace('.conf', '')
+    if not active in COLORS or not values.get('%s_port' % active):
+        abort(red('No blue/green backends found in %s, run setup with blue_green enabled.' % nginx_path))
+
+    return {
+        'active': active,
+        'idle': COLORS[1 - COLORS.index(active)],
+        'ports': dict([(c, int(values.get('%s_port' % c) or 0)) for c in COLORS]),
+        'instances': dict([(c, values.get('%s_instance' % c) or None) for c in COLORS]),
+    }
+
+
+def start_color(project_path, color, instance_path):
+    """ Points backend of color to instance and restarts it by touching its wsgi file """
+
+    link_path = os.path.join(project_path, '%s_instance' % color)
+
+    run('%s && touch %s/%s.wsgi' % (instance.swap_symbolic_link(link_path, instance_path), project_path, color))
+
+
+def warm_up(virtualenv_path, scripts_path, port):
+    """
+    Requests env.warmup_urls from backend until response times settle, returns True if no errors remain
+        - env.warmup_rounds (max rounds, default 10) and env.warmup_tolerance (default 0.2), see scripts/warmup.py
+    """
+
+    output = commands.python_run(virtualenv_path, '%s/warmup.py %d %s %d %s %s' % (
+        scripts_path,
+        port,
+        quote(env.website_name),
+        int(getattr(env, 'warmup_rounds', 10)),
+        float(getattr(env, 'warmup_tolerance', 0.2)),
+        str.join(' ', [quote(u) for u in getattr(env, 'warmup_urls', ['/'])])
+    ))
+    print(output)
+
+    return output.succeeded
+
+
+def switch_color(project_path, color):
+    """ Points nginx upstream to backend of color and reloads nginx gracefully, in one round trip """
+
+    upstream_path = os.path.join(get_nginx_path(project_path), 'upstream.conf')
+    other_color = COLORS[1 - COLORS.index(color)]
+
+    # a failed reload points the link back, so it keeps matching what nginx serves
+    output = run('%s && { %s || { %s; false; }; }' % (
+        instance.swap_symbolic_link(upstream_path, '%s.conf' % color),
+        get_reload_command(),
+        instance.swap_symbolic_link(upstream_path, '%s.conf' % other_color)
+    ))
+    if output.failed:
+        abort(red('Could not switch nginx to %s backend: %s' % (color, output)))
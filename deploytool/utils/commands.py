@@ -1,7 +1,37 @@
 from fabric.api import *
 from fabric.colors import *
 from fabric.contrib.files import *
+from fabric.state import connections
+from pipes import quote
+from StringIO import StringIO
+import base64
+import hashlib
+import json
 import os
+import subprocess
+import threading
+
+import records
+import trace
+
+
+# compress/decompress commands by name, compress commands take a level
+COMPRESSORS = {
+    'none': ('cat', 'cat'),
+    'gzip': ('gzip -%d -c', 'gzip -d -c'),
+    'xz': ('xz -%d -c', 'xz -d -c'),
+    'zstd': ('zstd -%d -c -q', 'zstd -d -c -q'),
+}
+
+# file extension by compression name
+EXTENSIONS = {
+    'none': '',
+    'gzip': '.gz',
+    'xz': '.xz',
+    'zstd': '.zst',
+}
+
+CHUNK_SIZE = 64 * 1024
 
 
 def get_folder_size(path):
@@ -18,13 +48,356 @@ def create_tarball(project_path, target, file_name='archive.tar'):
 
 
 def download_file(remote_path, local_path, delete_remote=True):
-
-    get(remote_path, local_path)
+    """
+    Downloads remote file in chunks over several SSH channels at once
+        - every chunk is checked against the SHA1 of the remote chunk, calculated
+          while it is sent (so the remote file is read only once), failed chunks are retried
+        - progress is kept in <local_path>.part.json, so a failed download
+          resumes with the missing chunks when called again for the same file
+        - remote file is deleted (if delete_remote) only after every chunk of the
+          complete local file matches its remote SHA1 and the remote file didn't change
+    """
+
+    # nothing is downloaded while tracing, that would write local state
+    if trace.active:
+        print(yellow('Tracing: download of %s skipped.' % remote_path))
+        return
+
+    # chunks are a whole number of MBs, see download_chunk()
+    chunk_size = max(1, int(getattr(env, 'download_chunk_size', 64 * 1024 * 1024)) // (1024 * 1024)) * 1024 * 1024
+    jobs = int(getattr(env, 'download_jobs', 4))
+    part_path = '%s.part' % local_path
+    state_path = '%s.part.json' % local_path
+
+    size, mtime = remote_output('stat -c "%%s %%Y" %s' % quote(remote_path)).split()
+    state = {'remote_path': remote_path, 'size': int(size), 'mtime': mtime, 'chunk_size': chunk_size, 'chunks': {}}
+
+    # resume only when the remote file didn't change since the previous attempt
+    keys = ['remote_path', 'size', 'mtime', 'chunk_size']
+    previous = os.path.exists(state_path) and os.path.exists(part_path) and json.load(open(state_path))
+    if previous and [previous.get(k) for k in keys] == [state[k] for k in keys]:
+        state = previous
+        print('Resuming download, %d chunks already done.' % len(state['chunks']))
+    else:
+        open(part_path, 'wb').close()
+
+    chunk_count = max(1, (state['size'] + chunk_size - 1) // chunk_size)
+    pending = [i for i in range(chunk_count) if not str(i) in state['chunks']]
+    lock = threading.Lock()
+    failed = []
+
+    def save_state():
+        open('%s.tmp' % state_path, 'w').write(json.dumps(state))
+        os.rename('%s.tmp' % state_path, state_path)
+
+    def worker():
+        while True:
+            with lock:
+                if not pending or failed:
+                    return
+                index = pending.pop(0)
+            try:
+                digest = download_chunk(remote_path, part_path, index, chunk_size)
+            except (Exception, SystemExit), e:
+                with lock:
+                    failed.append('chunk %d: %s' % (index, e))
+                return
+            with lock:
+                state['chunks'][str(index)] = digest
+                save_state()
+                print('Chunk %d of %d done.' % (len(state['chunks']), chunk_count))
+
+    save_state()
+    threads = [threading.Thread(target=worker) for i in range(min(jobs, len(pending)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if failed:
+        abort(red('Download of %s failed, run again to resume (%s).' % (remote_path, str.join(', ', failed))))
+
+    # whole file check, against the chunk digests instead of reading the remote file again
+    mismatches = []
+    part_file = open(part_path, 'rb')
+    for index in range(chunk_count):
+        chunk_sha1 = hashlib.sha1()
+        remaining = chunk_size
+        while remaining:
+            data = part_file.read(min(CHUNK_SIZE, remaining))
+            if not data:
+                break
+            chunk_sha1.update(data)
+            remaining -= len(data)
+        if chunk_sha1.hexdigest() != state['chunks'][str(index)]:
+            mismatches.append(index)
+    part_file.close()
+
+    # the next attempt downloads the chunks that don't match again
+    if mismatches or os.path.getsize(part_path) != state['size']:
+        for index in mismatches:
+            del state['chunks'][str(index)]
+        save_state()
+        abort(red('Checksum of %s does not match remote file, run again to resume.' % local_path))
+
+    # a remote file that changed during the download is a new download next time (see resume check)
+    if remote_output('stat -c "%%s %%Y" %s' % quote(remote_path)).split() != [size, mtime]:
+        abort(red('Remote file %s changed during download, run again to download it again.' % remote_path))
+
+    os.rename(part_path, local_path)
+    os.remove(state_path)
 
     if delete_remote:
         delete(remote_path)
 
 
+def download_chunk(remote_path, part_path, index, chunk_size, retries=3):
+    """
+    Downloads chunk index of remote file into local part file at the same offset
+        - returns SHA1 of the chunk, after checking it against the remote chunk
+    """
+
+    # dd counts in blocks, tee sends the chunk to stdout (fd 3) and to sha1sum, which prints to stderr
+    block_size = 1024 * 1024
+    blocks = chunk_size // block_size
+    chunk_command = '{ dd if=%s bs=%d skip=%d count=%d 2>/dev/null | tee /dev/fd/3 | sha1sum >&2; } 3>&1' % (
+        quote(remote_path),
+        block_size,
+        index * blocks,
+        blocks
+    )
+
+    for attempt in range(retries):
+        writer = ChunkWriter(part_path, index * blocks * block_size)
+        errors = StringIO()
+        try:
+            download_stream(chunk_command, writer, errors=errors)
+        finally:
+            writer.close()
+
+        remote_digest = (errors.getvalue().split() or [None])[0]
+        if writer.sha1.hexdigest() == remote_digest:
+            return remote_digest
+
+        print(yellow('Checksum of chunk %d does not match, retrying.' % index))
+
+    raise Exception('checksum does not match after %d attempts' % retries)
+
+
+class ChunkWriter(object):
+    """ File-like object writing into a file at offset, keeping SHA1 of the written data """
+
+    def __init__(self, path, offset):
+
+        self.file = open(path, 'r+b')
+        self.file.seek(offset)
+        self.sha1 = hashlib.sha1()
+
+    def write(self, data):
+
+        self.file.write(data)
+        self.sha1.update(data)
+
+    def close(self):
+
+        self.file.close()
+
+
+def remote_output(command):
+    """ Returns stdout of remote command, run over its own SSH channel (safe to use from threads) """
+
+    output = StringIO()
+    download_stream(command, output)
+
+    return output.getvalue()
+
+
+def find_partial_download(local_folder, prefix):
+    """ Returns remote path of the most recent unfinished download_file() into local_folder, for files starting with prefix """
+
+    candidates = []
+    for name in os.listdir(local_folder):
+        if name.startswith(prefix) and name.endswith('.part.json'):
+            path = os.path.join(local_folder, name)
+            candidates.append((os.path.getmtime(path), path))
+
+    if not candidates:
+        return None
+
+    return json.load(open(max(candidates)[1]))['remote_path']
+
+
+def format_size(size):
+    """ Returns human-readable string for a number of bytes """
+
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if abs(size) < 1024.0:
+            return '%.1f %s' % (size, unit)
+        size = size / 1024.0
+
+    return '%.1f TB' % size
+
+
+def get_compressor(compression, level=6):
+    """ Returns (compress, decompress) shell commands for compression name """
+
+    if not compression in COMPRESSORS:
+        abort(red('Unknown compression `%s`, use one of: %s' % (
+            compression,
+            str.join(', ', sorted(COMPRESSORS.keys()))
+        )))
+
+    compress, decompress = COMPRESSORS[compression]
+    if '%d' in compress:
+        compress = compress % int(level)
+
+    return compress, decompress
+
+
+def open_channel(command, host_string=None):
+    """ Starts command on host_string (default current host) and returns its SSH channel for streaming """
+
+    channel = connections[host_string or env.host_string].get_transport().open_session()
+    channel.exec_command(command)
+    records.count_command()
+
+    return channel
+
+
+def upload_stream(stream, remote_command):
+    """
+    Pipes file-like stream into stdin of remote_command over the SSH channel
+        - returns number of bytes sent
+        - aborts when remote_command fails
+    """
+
+    channel = open_channel(remote_command)
+    sent = 0
+
+    try:
+        while True:
+            chunk = stream.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            channel.sendall(chunk)
+            sent += len(chunk)
+    except EnvironmentError:
+        # remote end closed early, its exit status tells why
+        pass
+
+    channel.shutdown_write()
+    status = channel.recv_exit_status()
+
+    if status != 0:
+        errors = channel.makefile_stderr('rb').read().strip()
+        channel.close()
+        abort(red('Remote command `%s` failed (%d): %s' % (remote_command, status, errors)))
+
+    channel.close()
+    records.count_bytes(sent=sent)
+    return sent
+
+
+def upload_pipe(local_command, remote_command, compression='gzip', level=6):
+    """
+    Streams stdout of local_command into stdin of remote_command
+        - data is compressed locally and decompressed remotely on the fly,
+          so nothing is written to disk and extraction overlaps with transfer
+        - returns tuple of (raw bytes, sent bytes)
+    """
+
+    compress, decompress = get_compressor(compression, level)
+    source = subprocess.Popen(local_command, shell=True, stdout=subprocess.PIPE)
+    compressor = subprocess.Popen(compress, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    raw_bytes = [0]
+
+    def pump():
+        while True:
+            chunk = source.stdout.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            compressor.stdin.write(chunk)
+            raw_bytes[0] += len(chunk)
+        compressor.stdin.close()
+
+    pump_thread = threading.Thread(target=pump)
+    pump_thread.daemon = True
+    pump_thread.start()
+
+    sent_bytes = upload_stream(compressor.stdout, '%s | %s' % (decompress, remote_command))
+
+    pump_thread.join()
+    if source.wait() != 0 or compressor.wait() != 0:
+        abort(red('Local command `%s` failed.' % local_command))
+
+    return raw_bytes[0], sent_bytes
+
+
+def download_stream(remote_command, stream, input_data=None, errors=None, host_string=None):
+    """
+    Writes stdout of remote_command into file-like stream over the SSH channel
+        - input_data (optional) is sent to stdin of remote_command while reading
+        - stderr goes into file-like errors (optional), it must be small
+        - runs on host_string instead of current host when given, so threads can use their own host
+        - returns number of bytes received
+        - aborts when remote_command fails
+    """
+
+    channel = open_channel(remote_command, host_string)
+    received = 0
+
+    def send():
+        if input_data:
+            channel.sendall(input_data)
+        channel.shutdown_write()
+
+    # send in a thread, remote side may start writing before it read all input
+    send_thread = threading.Thread(target=send)
+    send_thread.daemon = True
+    send_thread.start()
+
+    while True:
+        chunk = channel.recv(CHUNK_SIZE)
+        if not chunk:
+            break
+        stream.write(chunk)
+        received += len(chunk)
+
+    status = channel.recv_exit_status()
+    send_thread.join()
+
+    if status != 0:
+        errors = channel.makefile_stderr('rb').read().strip()
+        channel.close()
+        abort(red('Remote command `%s` failed (%d): %s' % (remote_command, status, errors)))
+
+    if errors:
+        errors.write(channel.makefile_stderr('rb').read())
+    channel.close()
+    records.count_bytes(received=received)
+    return received
+
+
+def download_pipe(remote_command, local_command, compression='gzip', level=6, input_data=None):
+    """
+    Streams stdout of remote_command into stdin of local_command
+        - data is compressed remotely and decompressed locally on the fly
+        - returns number of bytes received
+    """
+
+    compress, decompress = get_compressor(compression, level)
+    target = subprocess.Popen('%s | %s' % (decompress, local_command), shell=True, stdin=subprocess.PIPE)
+
+    received = download_stream('%s | %s' % (remote_command, compress), target.stdin, input_data)
+
+    target.stdin.close()
+    if target.wait() != 0:
+        abort(red('Local command `%s` failed.' % local_command))
+
+    return received
+
+
 def tail_file(file_path, lines=5):
     """ Output the last lines from a file to console """
 
@@ -82,7 +455,7 @@ def django_manage(virtualenv_path, project_source_path, command):
 
     python_path = os.path.join(project_source_path, 'manage.py')
     python_command = '%s %s' % (python_path, command)
-    python_run(virtualenv_path, python_command)
+    return python_run(virtualenv_path, python_command)
 
 
 def sql_execute_query(virtualenv_path, scripts_path, query):
@@ -97,3 +470,103 @@ def sql_execute_file(virtualenv_path, scripts_path, filename):
 
     python_command = '%s/sql_file.py "%s"' % (scripts_path, filename)
     python_run(virtualenv_path, python_command)
+
+
+class Batch(object):
+    """
+    Queues independent remote operations and runs them as one remote script (single round trip)
+
+        with utils.commands.Batch() as batch:
+            batch.create_folder(path)
+            link = batch.read_link(other_path)
+
+        print(link['output'])
+
+    Every queued operation is a dict with `operation`, `args`, `succeeded`
+    and `output` keys, which are filled in when the batch is executed.
+    By default the batch stops at the first failing operation (the rest is
+    marked skipped) and aborts with the errors on exit.
+    """
+
+    # shell snippet per operation, positional arguments are shell-quoted
+    snippets = {
+        'create_folder': 'if [ -e %(0)s ]; then echo "Path %(0)s already exists."; false; else mkdir %(0)s; fi',
+        'delete': 'rm -rf %(0)s',
+        'create_symbolic_link': 'ln -sf %(0)s %(1)s',
+        'copy': 'cp %(0)s %(1)s',
+        'rename': 'mv %(0)s %(1)s',
+        'read_link': 'readlink -f %(0)s',
+        'exists': 'test -e %(0)s',
+        'get_folder_size': 'du -h --summarize %(0)s',
+        'tail_file': 'tail --lines=%(1)s %(0)s',
+    }
+
+    marker = '__batch__'
+
+    def __init__(self, stop_on_error=True, abort_on_error=True):
+
+        self.stop_on_error = stop_on_error
+        self.abort_on_error = abort_on_error
+        self.operations = []
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        if exc_type is None:
+            self.execute()
+
+    def __getattr__(self, name):
+
+        if not name in self.snippets:
+            raise AttributeError(name)
+
+        def queue(*args):
+            operation = {'operation': name, 'args': args, 'succeeded': None, 'output': ''}
+            self.operations.append(operation)
+            return operation
+
+        return queue
+
+    def get_script(self):
+        """ Returns shell script that runs all queued operations and reports their results """
+
+        lines = []
+        for index, operation in enumerate(self.operations):
+            args = dict([(str(i), quote(str(a))) for i, a in enumerate(operation['args'])])
+            lines.append('out=$( { %s ; } 2>&1 ); status=$?' % (self.snippets[operation['operation']] % args))
+            lines.append('echo "%s %d $status $(printf %%s "$out" | base64 | tr -d \'\\n\')"' % (self.marker, index))
+            if self.stop_on_error:
+                lines.append('[ $status -eq 0 ] || exit 0')
+
+        return str.join('\n', lines)
+
+    def execute(self):
+        """ Runs queued operations in one remote command, returns list of operations with results """
+
+        if not self.operations:
+            return []
+
+        output = run(self.get_script())
+
+        for line in output.splitlines():
+            words = line.strip().split(' ')
+            if words[0] == self.marker:
+                operation = self.operations[int(words[1])]
+                operation['succeeded'] = bool(words[2] == '0')
+                operation['output'] = base64.b64decode(words[3] if len(words) > 3 else '').strip()
+
+        errors = []
+        for operation in self.operations:
+            if operation['succeeded'] is None:
+                operation['output'] = 'skipped'
+            if not operation['succeeded']:
+                errors.append('%(operation)s %(args)s: %(output)s' % operation)
+
+        if errors and self.abort_on_error:
+            abort(red('Batched remote operations failed:\n%s' % str.join('\n', errors)))
+
+        return self.operations
+
@@ -2,38 +2,248 @@ import datetime
 from fabric.api import *
 from fabric.colors import *
 from fabric.contrib.files import *
+from pipes import quote
+import json
+import re
 
 import commands
 
 
-def get_obsolete_instances(project_path):
-    """ Return obsolete instances from remote server """
+# marker in instances built by the stage task that were not activated yet
+STAGED_FILE = 'staged'
+
+# totals per top-level folder of the project, see scripts/size_index.py
+SIZE_INDEX_FILE = '.sizes.json'
+
+
+def get_inventory(project_path, sizes=False, link_targets=None):
+    """
+    Returns all instances on remote server in one round trip, newest (by ctime) first
+        - each instance is a dict of stamp, ctime (remote epoch seconds), age (seconds),
+          role ('current', 'previous', 'staged' or None) and, if sizes, size in bytes
+        - sizes are read from the size index (see update_size_index), instances missing from it count as 0
+        - link_targets => (old, new) as returned by set_current_instance(), so the links aren't read again
+    """
+
+    # without a known current instance the links are read, so it's never taken for an obsolete one
+    if link_targets and not link_targets[1]:
+        link_targets = None
+
+    pattern = '?' * 40
+    lines = [
+        'cd %s || exit 1' % project_path,
+        'echo "now=$(date +%s)"',
+    ]
+    if not link_targets:
+        lines.extend([
+            'echo "current=$(readlink current_instance)"',
+            'echo "previous=$(readlink previous_instance)"',
+        ])
+    lines.extend([
+        'for d in $(ls -1tcd %s 2>/dev/null); do echo "instance=$d $(stat -c %%Z $d) $(test -e $d/%s && echo staged)"; done' % (pattern, STAGED_FILE),
+    ])
+    if sizes:
+        lines.append('echo "sizes=$(cat %s 2>/dev/null)"' % SIZE_INDEX_FILE)
+
+    output = run(str.join('\n', lines))
+    values = {}
+    instances = []
+    for line in output.splitlines():
+        key, sep, value = line.strip().partition('=')
+        if key == 'instance':
+            parts = value.split()
+            instances.append({'stamp': parts[0], 'ctime': int(parts[1]), 'role': len(parts) > 2 and parts[2] or None})
+        else:
+            values[key] = value
+
+    if link_targets:
+        values['previous'], values['current'] = [t or '' for t in link_targets]
+
+    now = int(values.get('now') or 0)
+    areas = parse_size_index(values.get('sizes', ''))
+    for instance in instances:
+        if instance['stamp'] == values.get('current', '')[-40:]:
+            instance['role'] = 'current'
+        elif instance['stamp'] == values.get('previous', '')[-40:]:
+            instance['role'] = 'previous'
+        instance['age'] = now - instance['ctime']
+        if sizes:
+            instance['size'] = areas.get(instance['stamp'], {}).get('size', 0)
+
+    return instances
+
+
+def update_size_index(virtualenv_path, scripts_path, project_path, areas=None, rebuild=False):
+    """
+    Updates disk usage per top-level folder of the project, returns dict of folder => size, files, folders, updated
+        - areas => folders to refresh (default all), only subfolders with a changed mtime are listed again
+        - rebuild => scans every subfolder of all areas
+        - returns an empty dict when the index could not be updated (e.g. projects set up before scripts/size_index.py)
+    """
+
+    with settings(warn_only=True):
+        output = commands.python_run(virtualenv_path, '%s/size_index.py %s %s %s' % (
+            scripts_path,
+            project_path,
+            rebuild and 'rebuild' or 'refresh',
+            str.join(' ', areas or [])
+        ))
+    if output.failed:
+        print(yellow('Size index was not updated, run setup to install scripts/size_index.py.'))
+        return {}
+
+    return parse_size_index(output.strip().splitlines() and output.strip().splitlines()[-1] or '')
+
+
+def get_size_index_command(virtualenv_path, scripts_path, project_path):
+    """ Returns command that refreshes the size index of all areas, and drops the removed ones """
+
+    return '%s/bin/python %s/size_index.py %s refresh > /dev/null' % (virtualenv_path, scripts_path, project_path)
+
+
+def parse_size_index(output):
+    """ Returns areas of size index JSON, or an empty dict for a missing index """
 
     try:
-        with cd(project_path):
+        return json.loads(output)['areas']
+    except (ValueError, KeyError, TypeError):
+        return {}
+
+
+def select_obsolete_instances(inventory, keep=5, max_age=None, budget=None):
+    """
+    Returns stamps of instances outside the retention policy, instances with a role are always kept
+        - keep => number of newest instances to keep
+        - max_age => seconds, older instances are removed
+        - budget => bytes, oldest instances are removed until all instances fit (needs sizes in inventory)
+    """
+
+    obsolete = []
+    total_size = sum([i.get('size', 0) for i in inventory])
+
+    for index, instance in enumerate(inventory):
+        if instance['role']:
+            continue
+
+        if index >= keep or (max_age and instance['age'] > max_age):
+            obsolete.append(instance['stamp'])
+            total_size -= instance.get('size', 0)
+
+    # oldest first, until everything fits
+    for instance in reversed(inventory):
+        if not budget or total_size <= budget:
+            break
+        if not instance['role'] and not instance['stamp'] in obsolete:
+            obsolete.append(instance['stamp'])
+            total_size -= instance.get('size', 0)
+
+    return obsolete
+
+
+def remove_instances(project_path, log_path, stamps, cleanup_commands=None):
+    """
+    Removes instances without waiting for it
+        - instances are moved to project_path/.trash in one round trip, so they are gone for all following tasks
+        - deleting them (and then running cleanup_commands) is left to a detached background process,
+          its output goes to log_path/prune.log
+    """
+
+    trash_path = os.path.join(project_path, '.trash')
+    batch_path = os.path.join(trash_path, datetime.datetime.now().strftime('%Y%m%d%H%M%S%f'))
+    background_command = str.join('; ', ['rm -rf %s/*' % trash_path] + (cleanup_commands or []))
+
+    output = run('mkdir -p %s && mv %s %s/ && (setsid nohup sh -c %s >> %s 2>&1 < /dev/null &)' % (
+        batch_path,
+        str.join(' ', [os.path.join(project_path, s) for s in stamps]),
+        batch_path,
+        quote(background_command),
+        os.path.join(log_path, 'prune.log')
+    ), pty=False)
+    if output.failed:
+        abort(red('Could not remove instances: %s' % output))
+
+
+def get_backup_file(backup_path, name, backup_format=None):
+    """
+    Returns path for a new database backup
+        - format is env.database_backup_format unless given:
+          'single' => one sql file, its extension follows env.database_compression
+          'parallel' => folder with one compressed file per table (see is_parallel_backup)
+    """
+
+    compression = getattr(env, 'database_compression', 'gzip')
+    commands.get_compressor(compression)
 
-            # list directories, display name only, sort by ctime, filter by git-commit-tag-length
-            command = 'ls -1tcd */ | awk \'{ if(length($1) == 41) { print substr($1,0,40) }}\''
+    if (backup_format or getattr(env, 'database_backup_format', 'single')) == 'parallel':
+        return os.path.join(backup_path, name)
 
-            # split into list and return everything but the 5 newest instances
-            return run(command).split()[5:]
-    except:
-        return []
+    return os.path.join(backup_path, '%s.sql%s' % (name, commands.EXTENSIONS[compression]))
+
+
+def is_parallel_backup(file_path):
+    """ Parallel backups are folders without .sql extension """
+
+    return not '.sql' in os.path.basename(file_path)
+
+
+def find_backup_file(backup_path, name):
+    """ Returns path of an existing database backup (in any format), or None if not found """
+
+    candidates = [os.path.join(backup_path, '%s.sql%s' % (name, e)) for e in commands.EXTENSIONS.values()]
+    candidates.append(os.path.join(backup_path, name, 'manifest.json'))
+    output = run('ls -1d %s 2>/dev/null | head -n 1' % str.join(' ', candidates)).strip()
+
+    if output.endswith('manifest.json'):
+        return os.path.dirname(output)
+
+    return output or None
+
+
+def mark_database_skipped(backup_path):
+    """ Records that deploy of instance left the database untouched, so rollback needs no restore """
+
+    run('touch %s' % os.path.join(backup_path, 'db_skipped'))
+
+
+def is_database_skipped(backup_path):
+
+    return exists(os.path.join(backup_path, 'db_skipped'))
 
 
 def backup_database(virtualenv_path, scripts_path, file_path):
+    """
+    Consistent dump, compressed by file extension, timings/sizes are recorded in <file_path>.meta
+        - parallel backups dump env.database_jobs tables at a time and record them in manifest.json
+    """
+
+    level = int(getattr(env, 'database_compression_level', 6))
+
+    if is_parallel_backup(file_path):
+        commands.python_run(virtualenv_path, '%s/db_backup_parallel.py "%s" %d %d %s' % (
+            scripts_path,
+            file_path,
+            level,
+            int(getattr(env, 'database_jobs', 4)),
+            getattr(env, 'database_compression', 'gzip')
+        ))
+    else:
+        commands.python_run(virtualenv_path, '%s/db_backup.py "%s" %d' % (scripts_path, file_path, level))
 
-    commands.python_run(
-        virtualenv_path,
-        '%s/db_backup.py "%s"' % (scripts_path, file_path)
-    )
 
 def restore_database(virtualenv_path, scripts_path, file_path):
-    """ Drop, create, restore """
+    """ Drop, create, restore (decompressed by file extension, or in parallel for parallel backups) """
 
     commands.python_run(env.virtualenv_path, '%s/db_drop.py' % env.scripts_path)
     commands.python_run(env.virtualenv_path, '%s/db_create.py' % env.scripts_path)
-    commands.sql_execute_file(env.virtualenv_path, env.scripts_path, file_path)
+
+    if is_parallel_backup(file_path):
+        commands.python_run(env.virtualenv_path, '%s/db_restore_parallel.py "%s" %d' % (
+            env.scripts_path,
+            file_path,
+            int(getattr(env, 'database_jobs', 4))
+        ))
+    else:
+        commands.sql_execute_file(env.virtualenv_path, env.scripts_path, file_path)
 
 
 def create_virtualenv(virtualenv_path, project_user):
@@ -42,8 +252,25 @@ def create_virtualenv(virtualenv_path, project_user):
     run('virtualenv %s --no-site-packages' % virtualenv_path)
 
 
-def pip_install_requirements(virtualenv_path, requirements_path, cache_path, log_path):
-    """ Requires availability of Pip (0.8.1 or later) on remote system """
+def has_pending_migrations(virtualenv_path, project_source_path):
+    """ Checks South's `migrate --list` for unapplied migrations, False if South is not available """
+
+    output = commands.django_manage(virtualenv_path, project_source_path, 'migrate --list')
+
+    return bool(output.succeeded and '( )' in output)
+
+
+def get_pip_install_options(cache_path, wheelhouse_path=None):
+    """ Returns pip install options for installing from PyPI, or offline from a wheelhouse """
+
+    if wheelhouse_path:
+        return '--no-index --find-links=%s' % wheelhouse_path
+
+    return '--download-cache=%s --use-mirrors' % cache_path
+
+
+def pip_install_requirements(virtualenv_path, requirements_path, cache_path, log_path, wheelhouse_path=None):
+    """ Requires availability of Pip (0.8.1 or later, 1.4 or later for wheelhouse) on remote system """
 
     requirements_file = os.path.join(requirements_path, 'requirements.txt')
     log_file = os.path.join(log_path, 'pip.log')
@@ -51,8 +278,183 @@ def pip_install_requirements(virtualenv_path, requirements_path, cache_path, log
     if not exists(requirements_file) or not exists(virtualenv_path):
         abort(red('Could not install packages. Virtual environment or requirements.txt not found.'))
 
-    args = (virtualenv_path, requirements_file, cache_path, log_file)
-    run('%s/bin/pip install -r %s --download-cache=%s --use-mirrors --quiet --log=%s' % args)
+    args = (virtualenv_path, requirements_file, get_pip_install_options(cache_path, wheelhouse_path), log_file)
+    run('%s/bin/pip install -r %s %s --quiet --log=%s' % args)
+
+
+def get_requirements_hash(requirements_path):
+    """ Returns SHA1 of requirements.txt combined with the remote interpreter version """
+
+    requirements_file = os.path.join(requirements_path, 'requirements.txt')
+    return run('(python -V 2>&1; cat %s) | sha1sum' % requirements_file).split()[0]
+
+
+def read_requirements_hash(instance_path):
+    """ Returns requirements hash recorded for instance, or empty string if none """
+
+    return run('cat %s/requirements.sha1 2>/dev/null' % instance_path).strip()
+
+
+def write_requirements_hash(instance_path, requirements_hash):
+    """ Records requirements hash of instance's virtual environment """
+
+    run('echo %s > %s/requirements.sha1' % (requirements_hash, instance_path))
+
+
+def clone_virtualenv(from_path, to_path, hardlink=False):
+    """
+    Clones existing virtual environment and relocates it to to_path
+        - hardlink => share unchanged files with from_path (only safe if nothing gets installed)
+
+    Relocating rewrites files with sed, which replaces them instead of writing
+    through a hardlink, so from_path is never modified.
+    """
+
+    run('cp -a%s %s/. %s' % ('l' if hardlink else '', from_path, to_path))
+
+    # rewrite all .pth files, so later uploads of .pth files never write through a hardlink
+    run('sed -i "s|%s|%s|g" %s/lib/python*/site-packages/*.pth' % (from_path, to_path, to_path))
+
+    # fix absolute paths in other files (shebangs, activate scripts, .egg-link files)
+    run('find %s/bin %s/lib/python*/site-packages -maxdepth 1 -type f ! -name "*.pth" -print0 | %s | %s' % (
+        to_path,
+        to_path,
+        'xargs -0 -r grep -lIZF -- %s' % from_path,
+        'xargs -0 -r sed -i "s|%s|%s|g"' % (from_path, to_path)
+    ))
+
+
+def pip_sync_requirements(virtualenv_path, old_requirements_path, new_requirements_path, cache_path, log_path, wheelhouse_path=None):
+    """
+    Installs/uninstalls only the requirement lines that differ between two requirements.txt files
+        - returns False when the difference can't be applied line by line (e.g. options or URLs changed),
+          or when either requirements.txt can't be read
+    """
+
+    def read_lines(requirements_path):
+        with settings(hide('warnings', 'stdout', 'stderr'), warn_only=True):
+            output = run('cat %s' % os.path.join(requirements_path, 'requirements.txt'))
+        if output.failed:
+            return None
+        lines = [l.split('#')[0].strip() for l in output.splitlines()]
+        return set([l for l in lines if l != ''])
+
+    def package_name(line):
+        return re.split(r'[<>=!~;\[ ]', line)[0].lower()
+
+    old_lines = read_lines(old_requirements_path)
+    new_lines = read_lines(new_requirements_path)
+    if old_lines is None or new_lines is None:
+        return False
+
+    removed_lines = old_lines - new_lines
+    added_lines = new_lines - old_lines
+
+    for line in removed_lines | added_lines:
+        if line.startswith('-') or '://' in line:
+            return False
+
+    # packages that are only changed (e.g. version bump) get replaced by pip install
+    added_names = set([package_name(l) for l in added_lines])
+    removed_names = [package_name(l) for l in removed_lines if package_name(l) not in added_names]
+
+    if removed_names:
+        print('Uninstalling %s' % str.join(', ', removed_names))
+        if run('%s/bin/pip uninstall --yes %s' % (virtualenv_path, str.join(' ', removed_names))).failed:
+            abort(red('Could not uninstall packages.'))
+
+    if added_lines:
+        print('Installing %s' % str.join(', ', sorted(added_lines)))
+        args = (
+            virtualenv_path,
+            str.join(' ', [quote(l) for l in sorted(added_lines)]),
+            get_pip_install_options(cache_path, wheelhouse_path),
+            os.path.join(log_path, 'pip.log')
+        )
+        if run('%s/bin/pip install %s %s --quiet --log=%s' % args).failed:
+            abort(red('Could not install packages. See %s for details.' % args[3]))
+
+    return True
+
+
+def get_static_store_path(project_path):
+    """ Content-addressed store of static files shared by all instances, see scripts/static_store.py """
+
+    return os.path.join(project_path, 'static_store')
+
+
+def store_static_files(virtualenv_path, scripts_path, project_path, static_path, instance_path, previous_instance_path=None):
+    """
+    Moves collected static files into the project's static store and links them from static_path
+        - only files with new content are copied, instance_path/static.manifest lists the hashes
+        - files unchanged since previous_instance_path (same inode) are not hashed again
+        - links are hardlinks, or symlinks when env.static_store_link is 'symlink'
+    """
+
+    args = [
+        get_static_store_path(project_path),
+        static_path,
+        os.path.join(instance_path, 'static.manifest'),
+    ]
+    if previous_instance_path:
+        args.append(os.path.join(previous_instance_path, 'static.manifest'))
+    if getattr(env, 'static_store_link', 'hardlink') == 'symlink':
+        args.append('--symlink')
+
+    output = commands.python_run(virtualenv_path, '%s/static_store.py link %s' % (scripts_path, str.join(' ', args)))
+    if output.failed:
+        abort(red('Could not move static files into store: %s' % output))
+    print(output)
+
+
+def get_static_gc_command(virtualenv_path, scripts_path, project_path):
+    """ Returns command that removes static files from store that no instance refers to """
+
+    return '%s/bin/python %s/static_store.py gc %s %s' % (
+        virtualenv_path,
+        scripts_path,
+        get_static_store_path(project_path),
+        project_path
+    )
+
+
+def get_dedup_store_path(project_path):
+    """ Store of files shared by hardlink between instances, see scripts/dedup.py """
+
+    return os.path.join(project_path, 'dedup_store')
+
+
+def deduplicate_instance(virtualenv_path, scripts_path, project_path, instance_path):
+    """ Replaces files of instance that are identical to files of earlier instances by hardlinks """
+
+    output = commands.python_run(virtualenv_path, '%s/dedup.py link %s %s %d' % (
+        scripts_path,
+        get_dedup_store_path(project_path),
+        instance_path,
+        int(getattr(env, 'dedup_min_size', 1024))
+    ))
+    print(output)
+
+
+def get_dedup_gc_command(virtualenv_path, scripts_path, project_path):
+    """ Returns command that removes files from dedup store that are no longer linked from any instance """
+
+    return '%s/bin/python %s/dedup.py gc %s' % (virtualenv_path, scripts_path, get_dedup_store_path(project_path))
+
+
+def mark_instance_staged(instance_path):
+    """ Marks instance as complete and ready for activation """
+
+    run('touch %s' % os.path.join(instance_path, STAGED_FILE))
+
+
+def get_staged_instances(project_path):
+    """ Returns stamps of staged instances, most recently staged first """
+
+    with cd(project_path):
+        output = run('ls -1t */%s 2>/dev/null || true' % STAGED_FILE)
+
+    return [os.path.dirname(l.strip()) for l in output.splitlines() if l.strip()]
 
 
 def get_instance_stamp(instance_path):
@@ -61,22 +463,67 @@ def get_instance_stamp(instance_path):
     return commands.read_link(instance_path)[-40:]
 
 
+def swap_symbolic_link(symbolic_path, real_path):
+    """ Returns shell command that points symbolic_path to real_path atomically (rename of a temporary link) """
+
+    temporary_path = os.path.join(os.path.dirname(symbolic_path), '.%s.tmp' % os.path.basename(symbolic_path))
+
+    return 'ln -sfn %s %s && mv -Tf %s %s' % (real_path, temporary_path, temporary_path, symbolic_path)
+
+
 def set_current_instance(project_path, instance_path):
-    """ Delete previous, set current to previous and new to current """
+    """
+    Set current to previous and new to current in one round trip, returns (old target, new target)
+        - both links are replaced by rename(2), so current_instance resolves at any time
+    """
 
-    with cd(project_path):
-        commands.delete('./previous_instance')
+    current_path = os.path.join(project_path, 'current_instance')
+    previous_path = os.path.join(project_path, 'previous_instance')
 
-        if exists('./current_instance'):
-            commands.rename('./current_instance', './previous_instance')
+    lines = [
+        'old=$(readlink %s)' % current_path,
+        'if [ -n "$old" ]; then %s || exit 1; fi' % swap_symbolic_link(previous_path, '"$old"'),
+        '%s || exit 1' % swap_symbolic_link(current_path, instance_path),
+        'echo "old=$old"',
+        'echo "new=$(readlink %s)"' % current_path,
+    ]
+    output = run(str.join('\n', lines))
+    if output.failed:
+        abort(red('Could not update instance symlinks: %s' % output))
 
-        commands.create_symbolic_link(instance_path, './current_instance')
+    return _parse_link_targets(output)
 
 
 def rollback(project_path):
-    """ Updates symlinks: Remove current instance and rename previous to current """
+    """
+    Replace current by previous instance in one round trip, returns (old target, new target)
+        - rename(2) of previous_instance over current_instance, so current_instance resolves at any time
+        - returns None when there is no previous instance
+    """
 
-    with cd(project_path):
-        if exists('./previous_instance'):
-            commands.delete('./current_instance')
-            commands.rename('./previous_instance', './current_instance')
+    current_path = os.path.join(project_path, 'current_instance')
+    previous_path = os.path.join(project_path, 'previous_instance')
+
+    lines = [
+        'test -L %s || exit 0' % previous_path,
+        'old=$(readlink %s)' % current_path,
+        'new=$(readlink %s)' % previous_path,
+        'mv -Tf %s %s || exit 1' % (previous_path, current_path),
+        'echo "old=$old"',
+        'echo "new=$new"',
+    ]
+    output = run(str.join('\n', lines))
+    if output.failed:
+        abort(red('Could not update instance symlinks: %s' % output))
+    if not output.strip():
+        return None
+
+    return _parse_link_targets(output)
+
+
+def _parse_link_targets(output):
+    """ Returns (old target, new target) from `old=...` and `new=...` output lines """
+
+    targets = dict([l.strip().split('=', 1) for l in output.splitlines() if '=' in l])
+
+    return targets.get('old') or None, targets.get('new') or None
@@ -0,0 +1,150 @@
+from fabric.api import *
+from fabric.colors import *
+from StringIO import StringIO
+import gzip
+import json
+import os
+
+import commands
+import trace
+
+
+MANIFEST_FILE = '.media_manifest.json'
+
+
+def get_remote_manifest(media_path, with_hash=False):
+    """
+    Returns dict of path => [size, mtime, hash] for all files in remote media folder
+        - hash is None unless with_hash is given (md5sum reads every file, so this is slow)
+        - paths are unicode, like the keys of the local (JSON) manifest, files with names
+          that aren't UTF-8 are left out
+    """
+
+    manifest = {}
+    skipped = 0
+
+    # listings of large media folders are big but compress well
+    listing = StringIO()
+    commands.download_stream('cd %s && find . -type f -printf "%%P\\t%%s\\t%%T@\\n" | gzip -1 -c' % media_path, listing)
+    listing.seek(0)
+
+    for line in gzip.GzipFile(fileobj=listing).read().splitlines():
+        path, size, mtime = line.rsplit('\t', 2)
+        try:
+            path = path.decode('utf-8')
+        except UnicodeDecodeError:
+            skipped += 1
+            continue
+        manifest[path] = [int(size), mtime.split('.')[0], None]
+
+    if skipped:
+        print(yellow('Skipping %d files with names that are not UTF-8.' % skipped))
+
+    if with_hash:
+        hashes = StringIO()
+        commands.download_stream('cd %s && find . -type f -print0 | xargs -0 -r md5sum' % media_path, hashes)
+
+        for line in hashes.getvalue().splitlines():
+            md5, path = line.split('  ', 1)
+            path = path[2:] if path.startswith('./') else path
+            path = path.decode('utf-8', 'replace')
+            if path in manifest:
+                manifest[path][2] = md5
+
+    return manifest
+
+
+def load_local_manifest(local_path):
+    """ Returns manifest of files synced earlier to local_path, see get_remote_manifest() """
+
+    manifest_file = os.path.join(local_path, MANIFEST_FILE)
+
+    if not os.path.exists(manifest_file):
+        return {}
+
+    return json.load(open(manifest_file))
+
+
+def save_local_manifest(local_path, manifest):
+    """ Writes manifest atomically, so an interrupted sync never leaves it half written """
+
+    manifest_file = os.path.join(local_path, MANIFEST_FILE)
+
+    json.dump(manifest, open('%s.tmp' % manifest_file, 'w'))
+    os.rename('%s.tmp' % manifest_file, manifest_file)
+
+
+def is_changed(remote_entry, local_entry):
+    """ Compares manifest entries by hash when both have one, by size and mtime otherwise """
+
+    if not local_entry:
+        return True
+    if remote_entry[2] and local_entry[2]:
+        return remote_entry[2] != local_entry[2]
+
+    return remote_entry[:2] != local_entry[:2]
+
+
+def sync_media(media_path, local_path, with_hash=False, batch_size=256 * 1024 * 1024):
+    """
+    Downloads new and changed files from remote media folder into local_path
+        - files are sent in compressed batches of at most batch_size bytes
+        - local manifest is saved after every batch, so an interrupted sync
+          resumes with the first unfinished batch
+        - files removed remotely are dropped from the manifest, not deleted locally
+    """
+
+    remote_manifest = get_remote_manifest(media_path, with_hash)
+    local_manifest = load_local_manifest(local_path)
+
+    removed_paths = [p for p in local_manifest.keys() if not p in remote_manifest]
+    for path in removed_paths:
+        del local_manifest[path]
+
+    changed_paths = sorted([p for p in remote_manifest.keys() if is_changed(remote_manifest[p], local_manifest.get(p))])
+    total_size = sum([remote_manifest[p][0] for p in changed_paths])
+
+    print('%d of %d files changed (%s), %d removed remotely.' % (
+        len(changed_paths),
+        len(remote_manifest),
+        commands.format_size(total_size),
+        len(removed_paths)
+    ))
+
+    # nothing is downloaded while tracing, that would write local files
+    if trace.active:
+        return
+
+    if not os.path.exists(local_path):
+        os.makedirs(local_path)
+
+    # group files into batches
+    batches = [[]]
+    batch_bytes = 0
+    for path in changed_paths:
+        if batches[-1] and batch_bytes + remote_manifest[path][0] > batch_size:
+            batches.append([])
+            batch_bytes = 0
+        batches[-1].append(path)
+        batch_bytes += remote_manifest[path][0]
+
+    received_total = 0
+    for index, batch in enumerate([b for b in batches if b]):
+        received_total += commands.download_pipe(
+            # files changed while reading (status 1) are fine, the next sync gets them again
+            remote_command = 'cd %s && { tar --warning=no-file-changed -cf - --null -T - || [ $? -eq 1 ]; }' % media_path,
+            local_command = 'tar -xf - -C %s' % local_path,
+            compression = getattr(env, 'media_compression', 'gzip'),
+            level = getattr(env, 'media_compression_level', 1),
+            input_data = unicode.join(u'\0', batch).encode('utf-8')
+        )
+
+        for path in batch:
+            local_manifest[path] = remote_manifest[path]
+        save_local_manifest(local_path, local_manifest)
+
+        print('Batch %d: %d files, received %s in total.' % (index + 1, len(batch), commands.format_size(received_total)))
+
+    save_local_manifest(local_path, local_manifest)
+
+    return changed_paths
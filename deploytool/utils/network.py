@@ -0,0 +1,82 @@
+from fabric.api import *
+from fabric.colors import *
+from fabric.network import connect, join_host_strings, normalize
+from fabric.state import connections
+import atexit
+import threading
+import time
+
+
+# seconds spent on SSH handshakes by connection key, and in tasks by (task, host)
+handshake_times = {}
+task_times = []
+
+# whether report() is registered to run at exit
+registered = False
+
+
+def preconnect(hosts):
+    """
+    Opens SSH connections to all hosts at once, for current env.user
+        - connections end up in fabric's connection cache (keyed by user, host and port),
+          so every following task in this run reuses them
+        - hosts that would need a password prompt are skipped, fabric connects those when first used
+    """
+
+    global registered
+    if not registered:
+        atexit.register(report)
+        registered = True
+
+    threads = []
+    with settings(hide('aborts', 'warnings'), abort_on_prompts=True):
+        for host in hosts:
+            user, hostname, port = normalize(host)
+            key = join_host_strings(user, hostname, port)
+
+            if not key in connections:
+                thread = threading.Thread(target=_connect, args=(key, user, hostname, port))
+                thread.start()
+                threads.append(thread)
+
+        for thread in threads:
+            thread.join()
+
+
+def _connect(key, user, host, port):
+    """ Connect and cache client, see preconnect() """
+
+    start = time.time()
+    try:
+        client = connect(user, host, port)
+    except (Exception, SystemExit):
+        return
+
+    # keep idle connections alive between tasks
+    client.get_transport().set_keepalive(int(env.keepalive or 30))
+
+    connections[key] = client
+    handshake_times[key] = time.time() - start
+
+
+def record_task(name, seconds):
+    """ Adds time spent in a task on current host """
+
+    task_times.append((name, env.host_string, seconds))
+
+
+def report():
+    """ Prints time spent on SSH handshakes versus time spent in tasks """
+
+    if not handshake_times:
+        return
+
+    handshake_total = sum(handshake_times.values())
+    task_total = sum([t[2] for t in task_times])
+
+    print(green('\nSSH connections:'))
+    for key in sorted(handshake_times.keys()):
+        print('    %s\thandshake %.2fs' % (key, handshake_times[key]))
+    for name, host, seconds in task_times:
+        print('    %s on %s\t%.2fs' % (name, host, seconds))
+    print('    %d handshakes took %.2fs, tasks took %.2fs' % (len(handshake_times), handshake_total, task_total))
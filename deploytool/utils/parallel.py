@@ -0,0 +1,126 @@
+from contextlib import contextmanager
+from fabric.api import *
+from fabric.colors import *
+from fabric.network import disconnect_all, interpret_host_string
+from fabric.state import connections
+import multiprocessing
+import Queue
+import sys
+import threading
+
+
+class PrefixedStream(object):
+    """ File-like wrapper that prefixes every line written to stream """
+
+    def __init__(self, stream, prefix):
+
+        self.stream = stream
+        self.prefix = prefix
+        self.at_line_start = True
+
+    def write(self, data):
+
+        for line in data.splitlines(True):
+            if self.at_line_start:
+                self.stream.write(self.prefix)
+            self.stream.write(line)
+            self.at_line_start = line.endswith('\n')
+
+    def __getattr__(self, name):
+
+        return getattr(self.stream, name)
+
+
+@contextmanager
+def on_host(host):
+    """ Temporarily point fabric env to host """
+
+    previous = dict([(k, env.get(k)) for k in ['host_string', 'host', 'user', 'port']])
+    interpret_host_string(host)
+
+    try:
+        yield
+    finally:
+        env.update(previous)
+
+
+def run_on_hosts(hosts, func, pool_size):
+    """
+    Runs func(host) for every host in forked worker processes, at most pool_size at a time
+        - output of each worker is prefixed with its host
+        - returns dict of host => (succeeded, result or error message)
+    """
+
+    results = {}
+    pending = list(hosts)
+    running = {}
+    queue = multiprocessing.Queue()
+
+    while pending or running:
+
+        # keep the pool filled
+        while pending and len(running) < pool_size:
+            host = pending.pop(0)
+            process = multiprocessing.Process(target=_run_worker, args=(host, func, queue))
+            process.start()
+            running[host] = process
+
+        try:
+            host, succeeded, result = queue.get(timeout=1)
+            results[host] = (succeeded, result)
+            running.pop(host).join()
+        except Queue.Empty:
+            # worker died without reporting back
+            for host, process in running.items():
+                if not process.is_alive() and queue.empty():
+                    results[host] = (False, 'worker exited with code %s' % process.exitcode)
+                    running.pop(host)
+
+    return results
+
+
+def run_in_threads(hosts, func):
+    """
+    Runs func(host) for every host at once in threads of this process
+        - threads share fabric's connection cache, so connections opened by utils.network.preconnect() are reused
+        - fabric env is shared too, func must use host instead of env.host_string
+        - returns dict of host => (succeeded, result or error message)
+    """
+
+    results = {}
+
+    def worker(host):
+        try:
+            results[host] = (True, func(host))
+        except SystemExit:
+            results[host] = (False, 'aborted')
+        except Exception, e:
+            results[host] = (False, str(e))
+
+    threads = [threading.Thread(target=worker, args=(host,)) for host in hosts]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return results
+
+
+def _run_worker(host, func, queue):
+    """ Worker process for run_on_hosts() """
+
+    # connections inherited from the parent process can't be shared, open new ones
+    connections.clear()
+
+    sys.stdout = PrefixedStream(sys.stdout, '[%s] ' % host)
+    sys.stderr = PrefixedStream(sys.stderr, '[%s] ' % host)
+
+    try:
+        with on_host(host):
+            queue.put((host, True, func(host)))
+    except SystemExit:
+        queue.put((host, False, 'aborted'))
+    except Exception, e:
+        queue.put((host, False, str(e)))
+    finally:
+        disconnect_all()
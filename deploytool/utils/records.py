@@ -0,0 +1,290 @@
+from datetime import datetime
+from fabric.api import *
+from fabric.colors import *
+from pipes import quote
+import base64
+import fabric.operations
+import json
+import os
+import threading
+import time
+
+
+RECORD_FILE = 'fabric.jsonl'
+
+# record of the task that is running, see start()
+current = None
+lock = threading.Lock()
+
+
+def start(task_name):
+    """
+    Starts a new run record for task on current host
+        - steps are timed from one step() call to the next
+        - remote commands and streamed bytes are counted per step
+    """
+
+    global current
+
+    _count_fabric_commands()
+
+    current = {
+        'task': task_name,
+        'environment': env.get('environment'),
+        'host': env.host_string,
+        'stamp': env.get('instance_stamp'),
+        'user': env.get('local_user'),
+        'started': datetime.today().strftime('%Y-%m-%d %H:%M:%S'),
+        'started_at': time.time(),
+        'seconds': 0,
+        'success': False,
+        'commands': 0,
+        'bytes_sent': 0,
+        'bytes_received': 0,
+        'steps': [],
+    }
+
+    return current
+
+
+def step(title):
+    """ Prints title of next step and starts timing it, ending the previous step """
+
+    print(green('\n%s' % title))
+
+    if current is None:
+        return
+
+    with lock:
+        _end_step()
+        current['steps'].append({
+            'title': title,
+            'host': env.host_string,
+            'started_at': time.time(),
+            'seconds': 0,
+            'commands': 0,
+            'bytes': 0,
+        })
+
+
+def count_command():
+    """ Adds a remote command to current record """
+
+    _add('commands', 1)
+
+
+def count_bytes(sent=0, received=0):
+    """ Adds bytes streamed to or from current host to current record """
+
+    _add('bytes_sent', sent)
+    _add('bytes_received', received)
+
+
+def note(key, value):
+    """ Stores value under key in current record (e.g. smoke test results) """
+
+    if current is None:
+        return
+
+    with lock:
+        current[key] = value
+
+
+def fork():
+    """ Clears steps and counters inherited by a worker process, see merge() """
+
+    if current is None:
+        return None
+
+    with lock:
+        current['steps'] = []
+        for key in ['commands', 'bytes_sent', 'bytes_received']:
+            current[key] = 0
+
+    return current
+
+
+def collect():
+    """ Ends last step of a worker process and returns its record, see merge() """
+
+    if current is None:
+        return None
+
+    with lock:
+        _end_step()
+
+    return current
+
+
+def merge(record):
+    """ Adds steps and counters of a worker's record (as returned by collect()) to current record """
+
+    if current is None or not record:
+        return
+
+    with lock:
+        _end_step()
+        current['steps'].extend(record['steps'])
+        for key in ['commands', 'bytes_sent', 'bytes_received']:
+            current[key] += record[key]
+
+
+def finish(success, use_sudo=False):
+    """ Ends current record and appends it as a single JSON line to log_path/fabric.jsonl """
+
+    global current
+
+    if current is None:
+        return
+
+    with lock:
+        record = current
+        _end_step()
+        record['success'] = bool(success)
+        record['seconds'] = round(time.time() - record.pop('started_at'), 2)
+        for s in record['steps']:
+            s.pop('started_at', None)
+        current = None
+
+    log_path = env.get('log_path')
+    if not log_path:
+        return
+
+    # base64 keeps the line intact through fabric's and the remote shell's escaping
+    line = base64.b64encode(json.dumps(record) + '\n')
+    record_file = quote(os.path.join(log_path, RECORD_FILE))
+    command = 'test -d %s && echo %s | base64 -d >> %s' % (quote(log_path), line, record_file)
+
+    if use_sudo:
+        # keep file owned by project user
+        sudo('%s && chown --reference=%s %s' % (command, quote(log_path), record_file))
+    else:
+        run(command)
+
+
+def parse(lines):
+    """ Returns records from JSON lines, skipping lines that can't be read """
+
+    records = []
+    for line in lines.splitlines():
+        try:
+            records.append(json.loads(line))
+        except ValueError:
+            pass
+
+    return records
+
+
+def percentile(values, percent):
+    """ Returns nearest-rank percentile of values """
+
+    values = sorted(values)
+    index = int(round(percent / 100.0 * len(values) + 0.5)) - 1
+
+    return values[max(0, min(index, len(values) - 1))]
+
+
+def summarize(records):
+    """
+    Returns lines summarizing records by task
+        - p50/p95 of total and of every step
+        - slowest step by p95
+        - trend: mean of latest half of runs versus the older half
+    """
+
+    lines = []
+    tasks = []
+    for record in records:
+        if not record['task'] in tasks:
+            tasks.append(record['task'])
+
+    for task in tasks:
+        runs = [r for r in records if r['task'] == task]
+        durations = [r['seconds'] for r in runs]
+        failed = len([r for r in runs if not r['success']])
+
+        lines.append('%s: %d runs (%d failed), p50 %.1fs, p95 %.1fs%s' % (
+            task,
+            len(runs),
+            failed,
+            percentile(durations, 50),
+            percentile(durations, 95),
+            _trend(durations)
+        ))
+
+        # step times by title, in order of first appearance
+        titles = []
+        step_times = {}
+        for run_record in runs:
+            for s in run_record['steps']:
+                if not s['title'] in step_times:
+                    titles.append(s['title'])
+                    step_times[s['title']] = []
+                step_times[s['title']].append(s['seconds'])
+
+        for title in titles:
+            lines.append('    %-50s p50 %7.1fs  p95 %7.1fs  (%d runs)' % (
+                title[:50],
+                percentile(step_times[title], 50),
+                percentile(step_times[title], 95),
+                len(step_times[title])
+            ))
+
+        if titles:
+            slowest = max(titles, key=lambda t: percentile(step_times[t], 95))
+            lines.append('    slowest step: %s' % slowest)
+
+    return lines
+
+
+def _trend(durations):
+    """ Returns description of change of the latest half of durations versus the older half """
+
+    if len(durations) < 4:
+        return ''
+
+    half = len(durations) // 2
+    older = sum(durations[:half]) / float(half)
+    latest = sum(durations[-half:]) / float(half)
+
+    if not older:
+        return ''
+
+    return ', trend %+d%%' % round((latest - older) / older * 100)
+
+
+def _end_step():
+    """ Sets duration of the last step of current record """
+
+    if current['steps'] and 'started_at' in current['steps'][-1]:
+        last = current['steps'][-1]
+        last['seconds'] = round(time.time() - last.pop('started_at'), 2)
+
+
+def _add(key, value):
+    """ Adds value to counter of current record and its running step """
+
+    if current is None or not value:
+        return
+
+    with lock:
+        current[key] += value
+        if current['steps']:
+            step_key = key == 'commands' and 'commands' or 'bytes'
+            current['steps'][-1][step_key] += value
+
+
+def _count_fabric_commands():
+    """ Counts every remote command run by fabric's run() and sudo() (including contrib.files helpers) """
+
+    if getattr(fabric.operations._run_command, 'counted', False):
+        return
+
+    run_command = fabric.operations._run_command
+
+    def counted_run_command(*args, **kwargs):
+        count_command()
+        return run_command(*args, **kwargs)
+
+    counted_run_command.counted = True
+    fabric.operations._run_command = counted_run_command
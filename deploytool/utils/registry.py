@@ -0,0 +1,54 @@
+from fabric.main import _task_names, crawl
+from fabric.tasks import Task
+import fabric.state
+import re
+
+
+# first docstring line of a task: category prefix and summary, e.g. 'REMO - Deploy new instance'
+SUMMARY = re.compile(r'^([A-Z]{4})\b(?:\s+-\s+(.*))?$')
+
+# tasks of the loaded fabfile, see get_tasks()
+registry = []
+
+# category and summary by task class, every docstring is parsed once
+summaries = {}
+
+
+def get_tasks():
+    """
+    Returns tasks of the loaded fabfile as list of dicts, collected on first call
+        - name => as passed to fab (with namespace, if any)
+        - category => prefix of the docstring (e.g. 'REMO'), None if missing
+        - description => rest of the first docstring line
+        - class => module and name of the Task subclass
+    """
+
+    if not registry:
+        for name in _task_names(fabric.state.commands):
+            task = crawl(name, fabric.state.commands)
+            if not isinstance(task, Task):
+                continue
+
+            category, description = parse_docstring(type(task))
+            registry.append({
+                'name': name,
+                'category': category,
+                'description': description,
+                'class': '%s.%s' % (type(task).__module__, type(task).__name__),
+            })
+
+    return registry
+
+
+def parse_docstring(task_class):
+    """ Returns (category, summary) from first line of docstring of task_class """
+
+    if not task_class in summaries:
+        lines = [l.strip() for l in (task_class.__doc__ or '').splitlines() if l.strip()]
+        match = lines and SUMMARY.match(lines[0])
+        if match:
+            summaries[task_class] = (match.group(1), match.group(2) or '')
+        else:
+            summaries[task_class] = (None, lines and lines[0] or '')
+
+    return summaries[task_class]
@@ -0,0 +1,87 @@
+from fabric.api import *
+from fabric.colors import *
+from pipes import quote
+import json
+import os
+
+import commands
+import records
+
+
+# latency differences below this many seconds are noise, whatever the threshold
+NOISE_SECONDS = 0.05
+
+
+def run_smoke_test(virtualenv_path, scripts_path, port):
+    """
+    Sends env.smoke_test_urls to website on port, returns dict of requests, error_rate, p50 and p95
+        - env.smoke_test_requests (default 100) in total, env.smoke_test_concurrency (default 4) at a time
+        - returns None when the test could not run
+    """
+
+    output = commands.python_run(virtualenv_path, '%s/smoke_test.py %d %s %d %d %s' % (
+        scripts_path,
+        port,
+        quote(env.website_name),
+        int(getattr(env, 'smoke_test_requests', 100)),
+        int(getattr(env, 'smoke_test_concurrency', 4)),
+        str.join(' ', [quote(u) for u in getattr(env, 'smoke_test_urls', ['/'])])
+    ))
+
+    try:
+        return json.loads(output.strip().splitlines()[-1])
+    except (ValueError, IndexError):
+        return None
+
+
+def get_baseline(log_path):
+    """ Returns smoke test result of the latest successful deploy in log_path/fabric.jsonl, or None """
+
+    output = run('tail -n 200 %s 2>/dev/null' % os.path.join(log_path, records.RECORD_FILE))
+
+    for record in reversed(records.parse(output)):
+        if record['success'] and record.get('smoke_test'):
+            return record['smoke_test']
+
+    return None
+
+
+def compare(result, baseline):
+    """
+    Returns list of regressions of result versus baseline (may be None)
+        - p50/p95 that grew more than env.smoke_test_threshold (default 0.5 is 50%)
+        - error rate that grew more than env.smoke_test_max_error_rate (default 0.01)
+    """
+
+    regressions = []
+    threshold = float(getattr(env, 'smoke_test_threshold', 0.5))
+    max_error_rate = float(getattr(env, 'smoke_test_max_error_rate', 0.01))
+
+    base_error_rate = baseline and baseline['error_rate'] or 0
+    if result['error_rate'] - base_error_rate > max_error_rate:
+        regressions.append('error rate %.1f%% (was %.1f%%)' % (result['error_rate'] * 100, base_error_rate * 100))
+
+    for key in ['p50', 'p95']:
+        if baseline and result[key] - baseline[key] > max(baseline[key] * threshold, NOISE_SECONDS):
+            regressions.append('%s %.0f ms (was %.0f ms)' % (key, result[key] * 1000, baseline[key] * 1000))
+
+    return regressions
+
+
+def describe(result, baseline):
+    """ Returns one line summary of result, with baseline values if any """
+
+    line = '%d requests, %.1f%% errors, p50 %.0f ms, p95 %.0f ms' % (
+        result['requests'],
+        result['error_rate'] * 100,
+        result['p50'] * 1000,
+        result['p95'] * 1000
+    )
+    if baseline:
+        line += ' (previous deploy: %.1f%% errors, p50 %.0f ms, p95 %.0f ms)' % (
+            baseline['error_rate'] * 100,
+            baseline['p50'] * 1000,
+            baseline['p95'] * 1000
+        )
+
+    return line
@@ -1,25 +1,139 @@
 from fabric.api import *
 from fabric.colors import *
 from fabric.contrib.files import *
+from pipes import quote
+from StringIO import StringIO
 import os
+import re
 
+import commands
 
-def transfer_source(upload_path, tree):
+
+def transfer_source(upload_path, tree, base_path=None, base_tree=None):
     """
     Archive source and upload/extract to/on remote server
         upload_path =>  target location to extract on remote
         tree        =>  git ID for branch, commit or tag
+        base_path   =>  source path of an instance already on remote (optional)
+        base_tree   =>  git ID that was deployed to base_path (optional)
+
+    When a base is given, unchanged files are seeded from base_path on remote
+    and only the added and changed paths are uploaded. Falls back to a full
+    archive when there is no usable base.
+    """
+
+    if base_path and base_tree and getattr(env, 'source_delta', True) and has_commit(base_tree):
+        if transfer_source_delta(upload_path, tree, base_path, base_tree):
+            return
+
+    transfer_archive(upload_path, tree)
+
+
+def transfer_archive(upload_path, tree, paths=None):
+    """
+    Stream compressed git archive of tree (optionally limited to paths) into
+    remote tar, without temporary tarballs on either end
+        - compression is set by env.source_compression (none/gzip/xz/zstd)
+          and env.source_compression_level
+    """
+
+    pathspec = str.join(' ', [quote(p) for p in paths or []])
+    raw_bytes, sent_bytes = commands.upload_pipe(
+        local_command = 'git archive --format=tar %s %s' % (tree, pathspec),
+        remote_command = 'tar -xf - -C %s' % upload_path,
+        compression = getattr(env, 'source_compression', 'gzip'),
+        level = getattr(env, 'source_compression_level', 6)
+    )
+
+    print('Sent %s for %s of source (compression ratio %.2f).' % (
+        commands.format_size(sent_bytes),
+        commands.format_size(raw_bytes),
+        float(raw_bytes) / max(sent_bytes, 1)
+    ))
+
+    return raw_bytes, sent_bytes
+
+
+def transfer_source_delta(upload_path, tree, base_path, base_tree):
+    """
+    Seed upload_path from base_path and upload the difference with base_tree
+        - returns False (without touching remote) when delta is not worthwhile
+
+    Only files tracked in base_tree are seeded, so untracked files in base_path
+    (settings.py, *.pyc, media link) never end up in the new instance.
+    Deleted paths are handled by not seeding them.
+    """
+
+    changed_files = get_changed_files(base_tree, tree)
+    shipped_files = changed_files.intersection(list_files(tree))
+    seeded_files = [f for f in sorted(list_files(base_tree)) if f not in changed_files]
+
+    if len(shipped_files) > int(getattr(env, 'source_delta_max_files', 1000)):
+        return False
+
+    print('Seeding %d unchanged files from %s, uploading %d changed files.' % (
+        len(seeded_files),
+        base_tree,
+        len(shipped_files)
+    ))
+
+    if getattr(env, 'source_seed', 'hardlink') == 'hardlink':
+        copy_args = '-Pl'
+    else:
+        copy_args = '-Pp'
+
+    # stream NUL separated paths to xargs, so file names with whitespace survive
+    commands.upload_stream(
+        StringIO(str.join('\0', seeded_files)),
+        'cd %s && xargs -0 -r cp %s --parents -t %s' % (base_path, copy_args, upload_path)
+    )
+
+    if shipped_files:
+        transfer_archive(upload_path, tree, sorted(shipped_files))
+
+    return True
+
+
+def list_files(tree):
+    """ Returns set of all file (blob) paths in tree """
+
+    output = local('git ls-tree -r -z %s' % tree, capture=True)
+    files = set()
+
+    # entries look like `<mode> <type> <object>\t<path>`
+    for entry in output.split('\0'):
+        if '\t' in entry:
+            info, path = entry.split('\t', 1)
+            if info.split()[1] == 'blob':
+                files.add(path)
+
+    return files
+
+
+def get_changed_files(from_tree, to_tree):
+    """ Returns set of paths that were added, changed or deleted between trees """
+
+    output = local('git diff --name-only --no-renames -z %s %s' % (from_tree, to_tree), capture=True)
+    return set([f for f in output.split('\0') if f != ''])
+
+
+def has_schema_changes(from_tree, to_tree):
     """
+    Checks if any file that can change the database schema differs between trees
+        - matches env.schema_file_pattern (regex), by default models, migrations,
+          fixtures and settings files
+    """
+
+    pattern = getattr(env, 'schema_file_pattern', r'(^|/)(models\.py|models/|migrations/|fixtures/|settings[^/]*\.py$)')
+    changed_files = get_changed_files(from_tree, to_tree)
+
+    return bool([f for f in changed_files if re.search(pattern, f)])
+
 
-    tar_file = 'source.tar'
-    local('git archive --format=tar --output=%s %s' % (tar_file, tree))
-    uploaded_files = put(tar_file, upload_path)
+def has_commit(tree):
+    """ Checks if git ID is known in local repository """
 
-    if uploaded_files.succeeded:
-        with cd(upload_path):
-            run('tar -xf %s' % uploaded_files[0])
-            run('rm -f ./%s' % tar_file)
-        local('rm -f ./%s' % tar_file)
+    return local('git cat-file -e %s^{commit}' % tree, capture=True).succeeded
 
 
 def create_tag(tag):
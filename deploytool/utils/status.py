@@ -0,0 +1,127 @@
+from fabric.api import *
+from fabric.colors import *
+from datetime import datetime
+from pipes import quote
+from StringIO import StringIO
+import deploytool
+import json
+import os
+
+import commands
+import records
+
+
+PROBE_SCRIPT = os.path.join(os.path.dirname(deploytool.__file__), 'scripts', 'probe.py')
+
+
+def probe(project_path, record_lines=100, host_string=None):
+    """
+    Returns status of project on host_string (default current host) as dict, in one round trip
+        - scripts/probe.py is sent to the remote python over stdin, so it needn't be installed
+        - returns None without output, e.g. while tracing (the probe isn't a read-only command)
+    """
+
+    output = StringIO()
+    commands.download_stream(
+        'python - %s %d' % (quote(project_path), record_lines),
+        output,
+        input_data=open(PROBE_SCRIPT).read(),
+        host_string=host_string
+    )
+
+    try:
+        return json.loads(output.getvalue())
+    except ValueError:
+        return None
+
+
+def find_drift(results):
+    """ Returns hosts whose current instance differs from the one most hosts run """
+
+    stamps = [r['current'] for r in results.values()]
+    if not stamps:
+        return []
+
+    majority = max(stamps, key=stamps.count)
+
+    return [h for h in results if results[h]['current'] != majority]
+
+
+def format_table(hosts, results, errors):
+    """ Returns lines of a table with a row per host, followed by its instances """
+
+    format_size = lambda size: size is None and '-' or commands.format_size(size)
+    drifting = find_drift(results)
+    show_backend = bool([r for r in results.values() if r.get('active_backend')])
+
+    lines = ['%-20s %-10s %-10s %10s %10s %16s %-6s %s' % (
+        'host', 'current', 'previous', 'instances', 'media', 'free', show_backend and 'color' or '', 'last run'
+    )]
+
+    for host in hosts:
+        if host in errors:
+            lines.append('%-20s %s' % (host, red(errors[host])))
+            continue
+
+        result = results[host]
+        current = '%-10s' % (result['current'] or '[none]')[:10]
+        lines.append('%-20s %s %-10s %10s %10s %16s %-6s %s' % (
+            host,
+            host in drifting and red(current) or current,
+            (result['previous'] or '[none]')[:10],
+            format_size(get_instances_size(result)),
+            format_size(result['media_size']),
+            '%s (%d%%)' % (format_size(result['disk_free']), 100 * result['disk_free'] / max(result['disk_total'], 1)),
+            result.get('active_backend') or '',
+            describe_last_run(result)
+        ))
+        lines.append('    load %s, %s' % (str.join(' ', ['%.2f' % l for l in result['load']]), describe_sizes(result)))
+
+        for instance in result['instances']:
+            lines.append('    %s %10s  %s' % (instance['stamp'], format_size(instance['size']), instance['role'] or ''))
+
+    if drifting:
+        lines.append(red('\nInstance drift: %s not running %s' % (
+            str.join(', ', drifting),
+            [r['current'] for h, r in results.items() if not h in drifting][0] or 'the same instance'
+        )))
+
+    return lines
+
+
+def get_instances_size(result):
+    """ Returns total size of instances, or None when some are missing from the size index """
+
+    sizes = [i['size'] for i in result['instances']]
+    if None in sizes:
+        return None
+
+    return sum(sizes)
+
+
+def describe_sizes(result):
+    """ Returns age and total of the size index (see utils.instance.update_size_index) """
+
+    if not result.get('sizes_updated'):
+        return yellow('no size index yet, run the sizes task')
+
+    return 'project %s, sizes as of %s' % (
+        commands.format_size(result['total_size'] or 0),
+        datetime.fromtimestamp(result['sizes_updated']).strftime('%Y-%m-%d %H:%M')
+    )
+
+
+def describe_last_run(result):
+    """ Returns description of the latest task record, or the last fabric.log line for projects without records """
+
+    runs = records.parse(str.join('\n', result['records']))
+    if runs:
+        run_record = runs[-1]
+        return '%s %s %s (%.0fs)' % (
+            run_record['task'],
+            run_record['success'] and 'ok' or red('failed'),
+            run_record['started'],
+            run_record['seconds']
+        )
+
+    return result['fabric_log'] and result['fabric_log'][-1] or ''
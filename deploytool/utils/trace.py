@@ -0,0 +1,336 @@
+from fabric.api import *
+from fabric.colors import *
+from StringIO import StringIO
+import fabric.contrib.files
+import fabric.operations
+import glob
+import os
+import re
+import sys
+import threading
+
+import commands
+
+
+# commands that only read state, these still run so the traced task follows the real code path
+READ_ONLY_REMOTE = re.compile(r'^(test|true|\[|readlink|cat|ls|du|find|stat|sha1sum|md5sum|tail|head|grep|sort|awk|wc|cut|cd|echo|python -V|gzip -\d+ -c|dd if=\S+ bs=\d+ skip=\d+ count=\d+)( |$)')
+READ_ONLY_LOCAL = re.compile(r'^(git (ls-tree|diff|cat-file|show|log|rev-parse|archive)|git tag$|cat |\S*pip --version$)')
+WRITING = re.compile(r'(^|[^0-9&])>|-delete|-exec|sed -i|xargs|\btee\b')
+
+PACKAGE_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# traced operations, see start()
+active = False
+operations = []
+
+# remote paths mentioned by skipped commands, exists() assumes these were created
+skipped_paths = []
+
+lock = threading.Lock()
+local_state = threading.local()
+originals = {}
+
+
+def is_read_only(command, remote=True):
+    """ True when every part of a (compound) shell command only reads """
+
+    if WRITING.search(command.replace('2>&1', '').replace('2>/dev/null', '')):
+        return False
+
+    pattern = remote and READ_ONLY_REMOTE or READ_ONLY_LOCAL
+    parts = re.split(r'\|\||&&|;|\|', command)
+
+    return all([pattern.match(p.strip().lstrip('(').strip()) for p in parts if p.strip().strip(')')])
+
+
+def start():
+    """
+    Traces remote and local operations of the running task without side effects
+        - run/sudo/local/put/get/exists/append and SSH channels are recorded
+          with command, estimated payload size, call site and utils helper
+        - read-only commands still run, everything else is skipped and reported successful
+    """
+
+    global active
+
+    active = True
+    del operations[:]
+    del skipped_paths[:]
+
+    _patch(fabric.operations, '_run_command', _traced_run_command)
+    _patch(commands, 'open_channel', _traced_open_channel)
+
+    # fabric functions are imported by name, so replace them in every module
+    for name, replacement in TRACED_FUNCTIONS.items():
+        originals[name] = (None, getattr(name in ['exists', 'append'] and fabric.contrib.files or fabric.operations, name))
+        for module in _get_modules():
+            if getattr(module, name, None) is originals[name][1]:
+                setattr(module, name, replacement)
+
+    print(yellow('\nTracing: remote changes are skipped, read-only commands still run.'))
+
+
+def stop():
+    """ Restores fabric functions and prints trace of all operations, then totals by helper """
+
+    global active
+
+    active = False
+    for name, replacement in TRACED_FUNCTIONS.items():
+        for module in _get_modules():
+            if getattr(module, name, None) is replacement:
+                setattr(module, name, originals[name][1])
+
+    fabric.operations._run_command = originals.pop('_run_command')[1]
+    commands.open_channel = originals.pop('open_channel')[1]
+
+    report()
+
+
+def report():
+    """ Prints every traced operation and a table aggregated by helper """
+
+    print(green('\nTraced operations:'))
+    for operation in operations:
+        print('    %-7s %-10s %-40s %s' % (
+            operation['operation'],
+            commands.format_size(operation['bytes']),
+            operation['call_site'],
+            operation['command'][:80].replace('\n', ' ')
+        ))
+
+    helpers = []
+    totals = {}
+    for operation in operations:
+        helper = operation['helper']
+        if not helper in totals:
+            helpers.append(helper)
+            totals[helper] = {'calls': 0, 'round_trips': 0, 'bytes': 0, 'operations': {}}
+        totals[helper]['calls'] += 1
+        totals[helper]['round_trips'] += int(operation['operation'] != 'local')
+        totals[helper]['bytes'] += operation['bytes']
+        totals[helper]['operations'][operation['operation']] = totals[helper]['operations'].get(operation['operation'], 0) + 1
+
+    print(green('\nTotals by helper (most round trips first):'))
+    print('    %-45s %6s %12s %10s  %s' % ('helper', 'calls', 'round trips', 'bytes', 'operations'))
+    helpers.sort(key=lambda h: -totals[h]['round_trips'])
+    for helper in helpers:
+        total = totals[helper]
+        print('    %-45s %6d %12d %10s  %s' % (
+            helper,
+            total['calls'],
+            total['round_trips'],
+            commands.format_size(total['bytes']),
+            str.join(', ', ['%s %d' % (k, v) for k, v in sorted(total['operations'].items())])
+        ))
+
+    print('    %-45s %6d %12d %10s' % (
+        'total',
+        len(operations),
+        len([o for o in operations if o['operation'] != 'local']),
+        commands.format_size(sum([o['bytes'] for o in operations]))
+    ))
+
+
+def _get_modules():
+    """ Returns deploytool modules and fabric modules that imported fabric functions by name """
+
+    return [m for m in sys.modules.values() if m and (m.__name__.startswith('deploytool.') or m is fabric.contrib.files)]
+
+
+def _patch(module, name, replacement):
+
+    originals[name] = (module, getattr(module, name))
+    setattr(module, name, replacement)
+
+
+def _record(operation, command, size=0):
+    """ Adds operation with call site (innermost deploytool frame) and helper (outermost utils frame) """
+
+    if getattr(local_state, 'depth', 0):
+        return None
+
+    call_site = '?'
+    helper = None
+    frame = sys._getframe(2)
+    while frame:
+        path = os.path.abspath(frame.f_code.co_filename)
+        if path.startswith(PACKAGE_PATH) and not path.startswith(os.path.dirname(__file__) + os.sep + 'trace'):
+            module_name = os.path.splitext(os.path.relpath(path, PACKAGE_PATH))[0].replace(os.sep, '.')
+            function_name = frame.f_code.co_name
+            if 'self' in frame.f_locals:
+                function_name = '%s.%s' % (type(frame.f_locals['self']).__name__, function_name)
+
+            if call_site == '?':
+                call_site = '%s:%d' % (module_name, frame.f_lineno)
+            if module_name.startswith('utils.'):
+                helper = '%s.%s' % (module_name, function_name)
+            elif helper is None:
+                helper = '%s.%s' % (module_name, function_name)
+        frame = frame.f_back
+
+    entry = {
+        'operation': operation,
+        'command': str(command),
+        'bytes': size,
+        'call_site': call_site,
+        'helper': helper or '?',
+    }
+    with lock:
+        operations.append(entry)
+
+    return entry
+
+
+def _skip(command):
+    """ Remembers absolute paths in a skipped command """
+
+    with lock:
+        skipped_paths.extend([p for p in re.findall(r"(/[^\s'\";|&)]+)", command) if p != '/dev/null'])
+
+
+def _result(output='', succeeded=True):
+    """ Returns a fabric style result for skipped commands """
+
+    result = fabric.operations._AttributeString(output)
+    result.failed = not succeeded
+    result.succeeded = succeeded
+    result.return_code = succeeded and 0 or 1
+    result.stderr = ''
+
+    return result
+
+
+def _traced_run_command(command, shell=True, pty=True, combine_stderr=None, sudo=False, user=None):
+
+    _record(sudo and 'sudo' or 'run', command, len(command))
+
+    if is_read_only(command):
+        local_state.depth = getattr(local_state, 'depth', 0) + 1
+        try:
+            return originals['_run_command'][1](command, shell, pty, combine_stderr, sudo, user)
+        finally:
+            local_state.depth -= 1
+
+    _skip(command)
+
+    # batched operations report success for every operation, see commands.Batch
+    markers = re.findall(r'echo "%s (\d+) ' % commands.Batch.marker, command)
+    return _result(str.join('\n', ['%s %s 0 ' % (commands.Batch.marker, i) for i in markers]))
+
+
+def _traced_open_channel(command, host_string=None):
+
+    entry = _record('channel', command, len(command))
+
+    if is_read_only(command):
+        return TracedChannel(originals['open_channel'][1](command, host_string), entry)
+
+    _skip(command)
+    return TracedChannel(None, entry)
+
+
+def _traced_put(local_path=None, remote_path=None, *args, **kwargs):
+
+    if hasattr(local_path, 'read'):
+        size = len(local_path.read())
+    else:
+        size = sum([os.path.getsize(p) for p in glob.glob(os.path.expanduser(local_path))])
+
+    _record('put', '%s => %s' % (getattr(local_path, 'name', local_path), remote_path), size)
+    _skip(remote_path)
+
+    return [remote_path]
+
+
+def _traced_get(remote_path, local_path=None):
+
+    _record('get', remote_path)
+
+    return [local_path]
+
+
+def _traced_local(command, capture=False):
+
+    _record('local', command)
+
+    if capture and is_read_only(command, remote=False):
+        return originals['local'][1](command, capture)
+
+    return _result()
+
+
+def _traced_exists(path, use_sudo=False, verbose=False):
+
+    _record('exists', path, len(path))
+
+    for skipped_path in skipped_paths:
+        if path == skipped_path or path.startswith(skipped_path.rstrip('/') + '/'):
+            return True
+
+    local_state.depth = getattr(local_state, 'depth', 0) + 1
+    try:
+        return originals['exists'][1](path, use_sudo, verbose)
+    finally:
+        local_state.depth -= 1
+
+
+def _traced_append(filename, text, *args, **kwargs):
+
+    if isinstance(text, (list, tuple)):
+        text = str.join('\n', text)
+    _record('append', '%s >> %s' % (text, filename), len(text))
+    _skip(filename)
+
+
+TRACED_FUNCTIONS = {
+    'put': _traced_put,
+    'get': _traced_get,
+    'local': _traced_local,
+    'exists': _traced_exists,
+    'append': _traced_append,
+}
+
+
+class TracedChannel(object):
+    """ Channel that counts sent bytes, and skips the command unless it only reads """
+
+    def __init__(self, channel, entry):
+
+        self.channel = channel
+        self.entry = entry
+
+    def sendall(self, data):
+
+        if self.entry:
+            self.entry['bytes'] += len(data)
+        if self.channel:
+            self.channel.sendall(data)
+
+    def shutdown_write(self):
+
+        if self.channel:
+            self.channel.shutdown_write()
+
+    def recv(self, size):
+
+        if self.channel:
+            return self.channel.recv(size)
+        return ''
+
+    def recv_exit_status(self):
+
+        if self.channel:
+            return self.channel.recv_exit_status()
+        return 0
+
+    def makefile_stderr(self, mode='rb'):
+
+        if self.channel:
+            return self.channel.makefile_stderr(mode)
+        return StringIO()
+
+    def close(self):
+
+        if self.channel:
+            self.channel.close()
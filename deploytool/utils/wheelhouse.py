@@ -0,0 +1,115 @@
+from fabric.api import *
+from fabric.colors import *
+import hashlib
+import os
+import shutil
+
+import commands
+import trace
+
+
+def get_cache_path():
+    """ Returns local folder holding one wheelhouse per requirements hash """
+
+    return os.path.expanduser(getattr(env, 'wheelhouse_cache_path', os.path.join('~', '.deploytool', 'wheelhouse')))
+
+
+def get_requirements(tree):
+    """ Returns content of requirements.txt for git ID """
+
+    requirements_file = os.path.join(getattr(env, 'project_source_folder', ''), 'requirements.txt')
+    return local('git show %s:%s' % (tree, requirements_file), capture=True)
+
+
+def get_requirements_hash(requirements):
+    """ Returns SHA1 of requirements combined with the version of the local pip/interpreter """
+
+    pip_version = local('%s --version' % getattr(env, 'wheelhouse_pip', 'pip'), capture=True)
+    return hashlib.sha1(pip_version + '\n' + requirements).hexdigest()
+
+
+def build_wheelhouse(tree):
+    """
+    Builds wheels for requirements.txt of tree into the local cache, returns its path
+        - a cached wheelhouse for the same requirements hash is reused
+        - wheels must be built on a platform that matches the remote hosts
+    """
+
+    requirements = get_requirements(tree)
+    cache_path = get_cache_path()
+    wheelhouse_path = os.path.join(cache_path, get_requirements_hash(requirements))
+
+    # nothing is built or evicted while tracing, a skipped build would leave an empty wheelhouse in the cache
+    if trace.active:
+        print(yellow('Tracing: %s wheelhouse %s.' % (os.path.exists(wheelhouse_path) and 'using cached' or 'skipped building', wheelhouse_path)))
+        return wheelhouse_path
+
+    if os.path.exists(wheelhouse_path):
+        print('Using cached wheelhouse %s' % wheelhouse_path)
+    else:
+        print('Building wheelhouse %s' % wheelhouse_path)
+        build_path = '%s.build' % wheelhouse_path
+        if os.path.exists(build_path):
+            shutil.rmtree(build_path)
+        os.makedirs(build_path)
+
+        requirements_file = os.path.join(build_path, 'requirements.txt')
+        open(requirements_file, 'w').write(requirements)
+
+        args = (getattr(env, 'wheelhouse_pip', 'pip'), build_path, requirements_file)
+        if local('%s wheel --quiet --wheel-dir=%s -r %s' % args, capture=True).failed:
+            shutil.rmtree(build_path)
+            abort(red('Could not build wheelhouse for %s.' % tree))
+
+        # only complete builds end up in the cache
+        os.rename(build_path, wheelhouse_path)
+
+    # mark as most recently used
+    os.utime(wheelhouse_path, None)
+    evict_wheelhouses(cache_path, int(getattr(env, 'wheelhouse_cache_size', 1024 * 1024 * 1024)), keep=wheelhouse_path)
+
+    return wheelhouse_path
+
+
+def evict_wheelhouses(cache_path, max_size, keep=None):
+    """ Removes least recently used wheelhouses until cache fits max_size (bytes) """
+
+    if trace.active:
+        return
+
+    entries = []
+    for name in os.listdir(cache_path):
+        path = os.path.join(cache_path, name)
+        if os.path.isdir(path) and not name.endswith('.build'):
+            size = 0
+            for root, dirs, files in os.walk(path):
+                size += sum([os.path.getsize(os.path.join(root, f)) for f in files])
+            entries.append((os.path.getmtime(path), size, path))
+
+    entries.sort()
+    total_size = sum([e[1] for e in entries])
+
+    for mtime, size, path in entries:
+        if total_size <= max_size:
+            break
+        if path != keep:
+            print('Evicting wheelhouse %s (%s)' % (path, commands.format_size(size)))
+            shutil.rmtree(path)
+            total_size -= size
+
+
+def transfer_wheelhouse(wheelhouse_path, upload_path):
+    """ Streams local wheelhouse into (new) remote folder, wheels are already compressed """
+
+    # while tracing, a wheelhouse that isn't cached yet was not built
+    if trace.active and not os.path.exists(wheelhouse_path):
+        return
+
+    run('mkdir -p %s' % upload_path)
+    raw_bytes, sent_bytes = commands.upload_pipe(
+        local_command = 'tar -cf - -C %s .' % wheelhouse_path,
+        remote_command = 'tar -xf - -C %s' % upload_path,
+        compression = 'none'
+    )
+
+    print('Sent %s of wheels.' % commands.format_size(sent_bytes))
@@ -37,8 +37,11 @@ live = tasks.remote.RemoteHost(settings=dict(project_items + live_items))
 
 # deployment
 deploy = tasks.remote.Deployment()
+stage = tasks.remote.Stage()
+activate = tasks.remote.Activate()
 rollback = tasks.remote.Rollback()
 status = tasks.remote.Status()
+sizes = tasks.remote.Sizes()
 database = tasks.remote.Database()
 media = tasks.remote.Media()
 